@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012 Hugo Osvaldo Barrera <hugo@osvaldobarrera.com.ar>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+The venue category tree, flattened.
+
+foursquare returns categories as a nested tree (a few hundred KB of JSON).
+It's flattened once into a CategoryTree, which is kept in the local store in
+a compact form (see dumps), so it doesn't need to be parsed or walked again.
+"""
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+class Category(object):
+    """
+    A category.  parent is the parent's id (None for top-level ones), path is
+    the names of the category and its ancestors (ie: "Food > Pizza Place"),
+    and children are the ids of its subcategories.
+    """
+    __slots__ = ('id', 'name', 'parent', 'path', 'iconPrefix', 'iconSuffix', 'depth', 'children')
+
+    def __init__(self, id, name, parent, path, iconPrefix, iconSuffix, depth):
+        self.id = id
+        self.name = name
+        self.parent = parent
+        self.path = path
+        self.iconPrefix = iconPrefix
+        self.iconSuffix = iconSuffix
+        self.depth = depth
+        self.children = []
+
+    def icon(self, size="64"):
+        return self.iconPrefix + size + self.iconSuffix
+
+    def __repr__(self):
+        return "<Category %s>" % self.path
+
+
+class CategoryTree:
+    """
+    All categories, by id.  Top-level categories are the children of None.
+    """
+
+    def __init__(self):
+        self.__categories = dict()
+        self.__roots = []
+
+    def __add(self, id, name, parentId, iconPrefix, iconSuffix):
+        parent = self.__categories.get(parentId)
+        if parent is None:
+            category = Category(id, name, None, name, iconPrefix, iconSuffix, 0)
+            self.__roots.append(id)
+        else:
+            category = Category(id, name, parentId, parent.path + " > " + name, iconPrefix, iconSuffix, parent.depth + 1)
+            parent.children.append(id)
+        self.__categories[id] = category
+
+    def flatten(cls, categories):
+        """
+        Builds the tree out of the nested categories returned by the API.
+        """
+        tree = cls()
+        pending = [(None, category) for category in reversed(categories)]
+        while pending:
+            parentId, category = pending.pop()
+            tree.__add(category['id'], category['name'], parentId,
+                       category['icon']['prefix'], category['icon']['name'])
+            for child in reversed(category.get('categories', [])):
+                pending.append((category['id'], child))
+        return tree
+    flatten = classmethod(flatten)
+
+    def loads(cls, text):
+        """
+        Builds the tree out of the text returned by dumps.
+        """
+        tree = cls()
+        for id, name, parentId, iconPrefix, iconSuffix in json.loads(text):
+            tree.__add(id, name, parentId, iconPrefix, iconSuffix)
+        return tree
+    loads = classmethod(loads)
+
+    def dumps(self):
+        """
+        Returns the tree as text: a row per category, parents first.
+        """
+        rows = []
+        pending = list(reversed(self.__roots))
+        while pending:
+            category = self.__categories[pending.pop()]
+            rows.append((category.id, category.name, category.parent, category.iconPrefix, category.iconSuffix))
+            pending.extend(reversed(category.children))
+        return json.dumps(rows, separators=(',', ':'))
+
+    def get(self, id):
+        return self.__categories.get(id)
+
+    def children(self, id=None):
+        """
+        Returns the subcategories of a category (or the top-level ones).
+        """
+        if id is None:
+            ids = self.__roots
+        else:
+            ids = self.__categories[id].children
+        return [self.__categories[child] for child in ids]
+
+    def categories(self):
+        return self.__categories.values()
+
+    def __len__(self):
+        return len(self.__categories)
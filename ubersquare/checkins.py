@@ -17,10 +17,7 @@
 from PySide.QtGui import QDialog, QLabel, QPushButton, QVBoxLayout, QWidget, QGridLayout, QCheckBox
 from PySide.QtCore import SIGNAL
 import foursquare
-try:
-    import json
-except ImportError:
-    import simplejson as json
+from objects import CheckinResult
 
 
 class Checkin:
@@ -99,25 +96,25 @@ class CheckinDetails(QDialog):
         self.checking_details = checking_details
         self.setWindowTitle("Check-in successful")
 
+        result = CheckinResult.get(checking_details)
+
         message = ""
+        for item in result.messages:
+            message += item + "<p>"
+
         score = ""
-        mayorship = ""
-        badge = ""
+        if result.total is not None:
+            score += "Total points: %d" % result.total
+            for points, scoreMessage in result.scores:
+                score += "<br>+%(points)d   %(message)s" % \
+                {'points': points, 'message': scoreMessage}
+            score += "<p>"
 
-        for item in checking_details['notifications']:
-            if item['type'] == "message":
-                message += item['item']['message'] + "<p>"
-            elif item['type'] == "score":
-                score += "Total points: %d" % item['item']['total']
-                for scoreItem in item['item']['scores']:
-                    score += "<br>+%(points)d   %(message)s" % \
-                    {'points': scoreItem['points'], 'message': scoreItem['message']}
-                score += "<p>"
-            elif item['type'] == "mayorship":
-                mayorship = item['item']['message']
-            elif item['type'] == "badge":
-                print json.dumps(item['item'], sort_keys=True, indent=4)
-                badge = "You got the \"" + item['item']['name'] + "\" badge!"
+        mayorship = result.mayorship or ""
+
+        badge = ""
+        for name in result.badges:
+            badge = "You got the \"" + name + "\" badge!"
 
         text = message + score + mayorship + badge
 
@@ -16,7 +16,7 @@
 
 from PySide.QtGui import QDialog, QVBoxLayout, QLabel
 from PySide.QtCore import Signal, SIGNAL
-from PySide.QtMaemo5 import QMaemo5ValueButton, QMaemo5ListPickSelector
+from PySide.QtMaemo5 import QMaemo5ValueButton, QMaemo5ListPickSelector, QMaemo5InformationBox
 
 
 class SignalEmittingValueButton(QMaemo5ValueButton):
@@ -38,6 +38,189 @@ class WaitingDialog(QDialog):
 		self.setWindowTitle("Please wait")
 
 
+###################### EVENTS ######################
+from PySide.QtCore import QObject, Qt
+
+
+class EventDispatcher(QObject):
+	"""
+	Delivers foursquare.events to subscribers in the thread this is created
+	in (ie: the GUI thread), through a queued signal.
+	"""
+	def __init__(self, bus):
+		super(EventDispatcher, self).__init__()
+		self.bus = bus
+		self.connect(self, SIGNAL("eventsPending()"), self.__deliver, Qt.QueuedConnection)
+		bus.set_dispatcher(self.__wake)
+
+	def __wake(self):
+		self.emit(SIGNAL("eventsPending()"))
+
+	def __deliver(self):
+		self.bus.deliver()
+
+
+###################### ICONS #######################
+from PySide.QtGui import QIcon
+import foursquare
+
+_icons = dict()
+
+
+def icon(url):
+	"""
+	Returns a QIcon for the image at url, loading each image just once.
+	This is called while painting, so images are downloaded without
+	retrying, and an empty icon is shown for those that can't be (for now).
+	"""
+	if url not in _icons:
+		try:
+			_icons[url] = QIcon(foursquare.image(url, retry=False))
+		except IOError, e:
+			print "Couldn't load icon (%s)" % e
+			return QIcon()
+	return _icons[url]
+
+
+###################### LISTS #######################
+from PySide.QtCore import QAbstractListModel, QModelIndex, Qt, QTimer
+from PySide.QtGui import QListView, QLineEdit, QSortFilterProxyModel
+from rows import diff_rows
+from textindex import TextIndex
+
+
+class RowListModel(QAbstractListModel):
+	"""
+	Base for list models that hold precomputed rows (see rows.py).
+	Replacing the rows only notifies views of what actually changed, so that
+	scroll position and selection survive a refresh.
+	"""
+	def __init__(self, rows):
+		super(RowListModel, self).__init__()
+		self.rows = rows
+		self.__textIndex = None
+
+	def rowCount(self, role=Qt.DisplayRole):
+		return len(self.rows)
+
+	def textIndex(self):
+		"""
+		Returns an index of the rows' terms, built the first time it's needed.
+		"""
+		if self.__textIndex is None:
+			self.__textIndex = TextIndex([(row.id, row.terms) for row in self.rows])
+		return self.__textIndex
+
+	def setRows(self, rows):
+		self.__textIndex = None
+		operations = diff_rows(self.rows, rows)
+		if operations is None:
+			self.rows = rows
+			self.reset()
+			return
+
+		parent = QModelIndex()
+		for operation in operations:
+			if operation[0] == 'remove':
+				first, last = operation[1:]
+				self.beginRemoveRows(parent, first, last)
+				del self.rows[first:last + 1]
+				self.endRemoveRows()
+			elif operation[0] == 'insert':
+				first, rows = operation[1:]
+				self.beginInsertRows(parent, first, first + len(rows) - 1)
+				self.rows[first:first] = rows
+				self.endInsertRows()
+			elif operation[0] == 'move':
+				source, destination = operation[1:]
+				self.beginMoveRows(parent, source, source, parent, destination)
+				self.rows.insert(destination, self.rows.pop(source))
+				self.endMoveRows()
+			elif operation[0] == 'change':
+				row, newRow = operation[1:]
+				self.rows[row] = newRow
+				self.dataChanged.emit(self.index(row), self.index(row))
+		# Unchanged rows still get the newest data
+		self.rows[:] = rows
+
+	def appendRows(self, rows):
+		if not rows:
+			return
+		if self.__textIndex is not None:
+			for row in rows:
+				self.__textIndex.add(row.id, row.terms)
+		first = len(self.rows)
+		self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+		self.rows.extend(rows)
+		self.endInsertRows()
+
+
+class IndexedFilterProxyModel(QSortFilterProxyModel):
+	"""
+	Filters a RowListModel by a set of row ids, rather than by regexp.
+	"""
+	def __init__(self, parent):
+		super(IndexedFilterProxyModel, self).__init__(parent)
+		self.__matches = None
+
+	def setMatches(self, ids):
+		self.__matches = ids
+		self.invalidateFilter()
+
+	def filterAcceptsRow(self, sourceRow, sourceParent):
+		if self.__matches is None:
+			return True
+		return self.sourceModel().rows[sourceRow].id in self.__matches
+
+
+class FilteredListView(QListView):
+	"""
+	A list of a RowListModel, filtered by the model's text index.
+	"""
+	def __init__(self, model, parent):
+		super(FilteredListView, self).__init__(parent)
+		self.model = model
+		self.__query = ""
+
+		self.proxy = IndexedFilterProxyModel(self)
+		self.proxy.setSourceModel(self.model)
+		self.setModel(self.proxy)
+
+	def filter(self, text):
+		self.__query = text
+		if text:
+			self.proxy.setMatches(self.model.textIndex().search(text))
+		else:
+			self.proxy.setMatches(None)
+
+	def refilter(self):
+		if self.__query:
+			self.filter(self.__query)
+
+
+class FilterField(QLineEdit):
+	"""
+	A "type to filter" field.  callback(text) is called once typing pauses,
+	rather than on every keystroke.
+	"""
+	def __init__(self, callback, parent, delay=200):
+		super(FilterField, self).__init__(parent)
+		self.setPlaceholderText("Type to filter")
+		self.callback = callback
+
+		self.timer = QTimer(self)
+		self.timer.setSingleShot(True)
+		self.timer.setInterval(delay)
+		self.timer.timeout.connect(self.__filter)
+		self.textChanged.connect(self.__textChanged)
+
+	def __textChanged(self, text):
+		self.timer.start()
+
+	def __filter(self):
+		self.callback(self.text())
+
+
 ###################### CATEGORY #######################
 from PySide.QtCore import *
 from PySide.QtGui import *
@@ -45,6 +228,9 @@ import foursquare
 
 
 class CategoryModel(QAbstractListModel):
+	"""
+	A list of categories (as categories.Category objects).
+	"""
 	def __init__(self, categories):
 		super(CategoryModel, self).__init__()
 		self.categories = categories
@@ -57,15 +243,13 @@ class CategoryModel(QAbstractListModel):
 
 	def data(self, index, role=Qt.DisplayRole):
 		if role == Qt.DisplayRole:
-			return self.categories[index.row()]['name']
+			return self.categories[index.row()].name
 		elif role == Qt.DecorationRole:
-			prefix = self.categories[index.row()]['icon']['prefix']
-			extension = self.categories[index.row()]['icon']['name']
-			return QIcon(foursquare.image(prefix + "64" + extension))
+			return icon(self.categories[index.row()].icon())
 		elif role == CategoryModel.CategoryRole:
 			return self.categories[index.row()]
 		elif role == CategoryModel.SubCategoriesRole:
-			return self.categories[index.row()]['categories']
+			return self.categories[index.row()].children
 
 	def get_data(self, index):
 		return self.categories[index]
@@ -83,8 +267,9 @@ class CategorySelector(QWidget):
 		layout = QVBoxLayout()
 		self.setLayout(layout)
 
+		self.tree = foursquare.get_category_tree()
 		self.category = SignalEmittingValueButton("Category", self.category_selected, self)
-		self.category.setPickSelector(CategoryPickSelector(foursquare.get_venues_categories()))
+		self.category.setPickSelector(CategoryPickSelector(self.tree.children()))
 		self.category.setValueLayout(QMaemo5ValueButton.ValueBesideText)
 		self.subcategory = QMaemo5ValueButton("Subcategory", self)
 		self.subcategory.setValueLayout(QMaemo5ValueButton.ValueBesideText)
@@ -94,19 +279,19 @@ class CategorySelector(QWidget):
 
 	def category_selected(self, index):
 		if index != -1:
-			subcategories = self.category.pickSelector().model().get_data(index)['categories']
-			self.subcategory.setPickSelector(CategoryPickSelector(subcategories))
+			category = self.category.pickSelector().model().get_data(index)
+			self.subcategory.setPickSelector(CategoryPickSelector(self.tree.children(category.id)))
 
 	def selectedCategory(self):
 		# There's no pickSelector if a category wasn't even selected
 		if self.subcategory.pickSelector():
 			index = self.subcategory.pickSelector().currentIndex()
 			if index > -1:
-				return self.subcategory.pickSelector().model().get_data(index)['id']
+				return self.subcategory.pickSelector().model().get_data(index).id
 
 		index = self.category.pickSelector().currentIndex()
 		if index > -1:
-			return self.category.pickSelector().model().get_data(index)['id']
+			return self.category.pickSelector().model().get_data(index).id
 
 		return ""
 
@@ -127,6 +312,12 @@ class UberSquareWindow(QMainWindow):
 		networkError = Signal()
 		self.connect(self, SIGNAL("networkError()"), self.__networkError)
 
+		queued = Signal()
+		self.connect(self, SIGNAL("queued()"), self.__queued)
+
+		rejected = Signal()
+		self.connect(self, SIGNAL("rejected()"), self.__rejected)
+
 		self.waitDialog = WaitingDialog(self)
 		self.shown = False
 
@@ -148,6 +339,14 @@ class UberSquareWindow(QMainWindow):
 		d.addButton("Ok", QMessageBox.YesRole)
 		d.exec_()
 
+	def __queued(self):
+		self.waitDialog.hide()
+		QMaemo5InformationBox.information(self, "Couldn't reach foursquare; this will be sent once you're back online.")
+
+	def __rejected(self):
+		self.waitDialog.hide()
+		QMaemo5InformationBox.information(self, "foursquare refused this, so it wasn't sent.")
+
 
 ############## VISUAL WIDGETS ##############################
 
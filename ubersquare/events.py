@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012 Hugo Osvaldo Barrera <hugo@osvaldobarrera.com.ar>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Events published by the API layer (see foursquare.events), so that windows
+can react to writes without foursquare.py knowing about them.
+"""
+
+import threading
+import thread
+import weakref
+
+
+class Event(object):
+    __slots__ = ()
+
+
+class CheckinDone(Event):
+    """
+    A checkin was delivered, and the local state updated with it.
+    """
+    __slots__ = ('response',)
+
+    def __init__(self, response):
+        self.response = response
+
+
+class TipAdded(Event):
+    __slots__ = ('venueId', 'tip')
+
+    def __init__(self, venueId, tip):
+        self.venueId = venueId
+        self.tip = tip
+
+
+class VenueAdded(Event):
+    __slots__ = ('venue',)
+
+    def __init__(self, venue):
+        self.venue = venue
+
+
+class _Subscription:
+    """
+    Holds a callback weakly, if it's a bound method (ie: a window's), so that
+    subscribing doesn't keep the subscriber alive.
+    """
+
+    def __init__(self, eventType, callback):
+        self.eventType = eventType
+        self.thread = thread.get_ident()
+        if hasattr(callback, 'im_self') and callback.im_self is not None:
+            self.target = weakref.ref(callback.im_self)
+            self.function = callback.im_func
+        else:
+            self.target = None
+            self.function = callback
+
+    def callback(self):
+        """
+        Returns the callback, or None if the subscriber is gone.
+        """
+        if self.target is None:
+            return self.function
+        target = self.target()
+        if target is None:
+            return None
+        return self.function.__get__(target, target.__class__)
+
+
+class EventBus:
+    """
+    Publish/subscribe for Events.
+
+    Callbacks run in the thread that subscribed them, provided that thread
+    set a dispatcher (see set_dispatcher); otherwise, they run right away in
+    the publishing thread.  Queued events of the same type for the same
+    subscriber are merged: only the latest one is delivered.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__subscriptions = []
+        self.__dispatchers = dict()
+        # Per thread: keys, in order, and the latest event for each one
+        self.__pending = dict()
+
+    def set_dispatcher(self, dispatch):
+        """
+        Makes events for the calling thread's subscribers queued.  dispatch()
+        will be called, from any thread, whenever there's something queued;
+        it must make the calling thread run deliver() soon.
+        """
+        self.__lock.acquire()
+        try:
+            self.__dispatchers[thread.get_ident()] = dispatch
+        finally:
+            self.__lock.release()
+
+    def subscribe(self, eventType, callback):
+        self.__lock.acquire()
+        try:
+            self.__subscriptions.append(_Subscription(eventType, callback))
+        finally:
+            self.__lock.release()
+
+    def unsubscribe(self, callback):
+        self.__lock.acquire()
+        try:
+            self.__subscriptions = [s for s in self.__subscriptions if s.callback() not in (None, callback)]
+        finally:
+            self.__lock.release()
+
+    def publish(self, event):
+        immediate = []
+        wake = []
+        self.__lock.acquire()
+        try:
+            alive = []
+            for subscription in self.__subscriptions:
+                if subscription.callback() is None:
+                    continue
+                alive.append(subscription)
+                if not isinstance(event, subscription.eventType):
+                    continue
+                dispatch = self.__dispatchers.get(subscription.thread)
+                if dispatch is None:
+                    immediate.append(subscription)
+                    continue
+                keys, events = self.__pending.setdefault(subscription.thread, ([], dict()))
+                key = (id(subscription), event.__class__)
+                if not keys:
+                    wake.append(dispatch)
+                if key not in events:
+                    keys.append(key)
+                events[key] = (subscription, event)
+            self.__subscriptions = alive
+        finally:
+            self.__lock.release()
+
+        for dispatch in wake:
+            dispatch()
+        for subscription in immediate:
+            self.__call(subscription, event)
+
+    def deliver(self):
+        """
+        Delivers the events queued for the calling thread.
+        """
+        self.__lock.acquire()
+        try:
+            keys, events = self.__pending.pop(thread.get_ident(), ([], dict()))
+        finally:
+            self.__lock.release()
+        for key in keys:
+            subscription, event = events[key]
+            self.__call(subscription, event)
+
+    def __call(self, subscription, event):
+        callback = subscription.callback()
+        if callback is None:
+            return
+        try:
+            callback(event)
+        except Exception, e:
+            print "Error delivering %s (%s)" % (event.__class__.__name__, e)
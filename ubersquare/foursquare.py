@@ -22,8 +22,19 @@ import urllib
 import sys
 import sqlite3
 import os
+import time
+import threading
 from urlparse import urlparse
 from xdg import BaseDirectory
+from scheduler import RequestScheduler, RateBudget, Priority, set_priority, current_priority
+from network import RetryPolicy, RetryableError, Hedger
+from outbox import Outbox
+from store import LocalStore
+from prefetch import Prefetcher
+from categories import CategoryTree
+from objects import CheckinResult
+from events import EventBus, CheckinDone, TipAdded, VenueAdded
+from geo import parse_ll, geohash, geohash_tiles, geohash_center
 
 ###################
 # LOCAL CONSTANTS #
@@ -44,6 +55,19 @@ BROADCAST_DEFAULT = "public"
 ####################
 
 DEFAULT_FETCH_AMOUNT = 25
+# Items per request, for endpoints that return long lists
+PAGE_SIZE = 100
+# Seconds between full downloads of the venue history (see get_history)
+HISTORY_RESYNC_INTERVAL = 7 * 24 * 60 * 60
+# Search results are cached per geohash tile of this precision (~1.2x0.6km)
+SEARCH_TILE_PRECISION = 6
+SEARCH_CACHE_AGE = 24 * 60 * 60
+# Recent checkins kept in the cached profile when one is added locally
+PATCHED_CHECKINS = 10
+# Tiles this close to the current location are prefetched (see prefetch_area)
+AREA_PREFETCH_RADIUS = 1000
+# Seconds an image that couldn't be downloaded isn't tried again for
+IMAGE_FAILURE_TTL = 60
 
 #########################
 # FILES AND DIRECTORIES #
@@ -51,8 +75,10 @@ DEFAULT_FETCH_AMOUNT = 25
 
 # Directory that contains the cache
 cache_dir = os.path.join(BaseDirectory.xdg_cache_home, "ubersquare/")
+# Directory that contains persistent data
+data_dir = os.path.join(BaseDirectory.xdg_data_home, "ubersquare/")
 # Directory that contains cached images
-image_dir = os.path.join(BaseDirectory.xdg_data_home, "ubersquare/images/")
+image_dir = data_dir + "images/"
 # Directory that contains the configuration
 config_dir = os.path.join(BaseDirectory.xdg_config_home, "ubersquare/")
 
@@ -83,9 +109,38 @@ if not os.path.exists(query_cache):
 config = config_dir + "config.sqlite"
 if not os.path.exists(config):
     create_config_db()
+
+# Writes waiting to be sent to foursquare
+outbox = Outbox(data_dir + "outbox.sqlite")
+# Per-venue data (history, etc)
+store = LocalStore(query_cache)
     
 authData = dict()
 
+# Every network request goes through here, so that user actions never wait
+# behind prefetching or image downloads.
+scheduler = RequestScheduler()
+# API quota, shared by all requests.
+budget = RateBudget()
+# Only GETs are retried, since they're idempotent.
+retry_policy = RetryPolicy()
+# Interactive GETs may be hedged (see init()).
+hedger = Hedger()
+# Details of venues on screen (see prefetch_venues).  The budget is per
+# session, and can be set with the prefetch_requests/prefetch_bytes configs.
+prefetcher = Prefetcher(lambda venueId: _prefetch_venue(venueId))
+# Venues (and their icons) around the current location (see prefetch_area).
+# The budget can be set with the area_prefetch_requests/area_prefetch_bytes configs.
+area_prefetcher = Prefetcher(lambda tile: _prefetch_tile(tile), max_requests=20, max_bytes=2 * 1024 * 1024)
+# The flattened category tree (see get_category_tree)
+category_tree = None
+# Hit rate of the search results cache (see venues_search)
+search_cache_stats = {'hits': 0, 'prefix_hits': 0, 'misses': 0}
+# When each image that couldn't be downloaded last failed, by url
+image_failures = dict()
+# Checkins, tips and new venues are published here once delivered (see events.py)
+events = EventBus()
+
 #######################
 # AUX DEBUG FUNCTIONS #
 #######################
@@ -156,49 +211,128 @@ class Cache:
     ForceFetch = False
 
 
-def foursquare_get(path, params, read_cache=False, callback=None):
+def _urlread(url, data=None):
+    u = urllib.urlopen(url, data)
+    response = u.read()
+    headers = u.info()
+    budget.update(headers)
+    code = None
+    if hasattr(u, 'getcode'):
+        code = u.getcode()
+    u.close()
+    if code in (429, 500, 502, 503, 504):
+        retry_after = headers.getheader("Retry-After")
+        try:
+            retry_after = int(retry_after)
+        except (TypeError, ValueError):
+            retry_after = None
+        raise RetryableError("HTTP error %d" % code, retry_after)
+    return response
+
+
+def _get(url, priority):
     """
-    Performs an HTTP get on PATH.
+    GETs url, retrying with backoff, and hedging interactive requests.
     """
+    def attempt():
+        return scheduler.run(priority, _urlread, url)
+
+    if priority == Priority.Interactive:
+        return retry_policy.call(hedger.run, attempt)
+    return retry_policy.call(attempt)
+
+
+def _resource(path, params):
     commonParams = {'oauth_token': authData['ACCESS_TOKEN'], 'v': API_VERSION}
-    allParams = urllib.urlencode(dict(commonParams.items() + params.items()))
+    return path + "?" + urllib.urlencode(dict(commonParams.items() + params.items()))
 
-    resource = path + "?" + allParams
+
+def is_cached(path, params):
+    """
+    Returns whether there's a cached response for a GET, without parsing it.
+    """
     conn = sqlite3.connect(query_cache)
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM queries WHERE resource = ?", (_resource(path, params),))
+    cached = c.fetchone() is not None
+    conn.close()
+    return cached
+
+
+def _cache_get(resource):
+    conn = sqlite3.connect(query_cache)
+    c = conn.cursor()
+    c.execute("SELECT value FROM queries WHERE resource = ?", (resource,))
+    row = c.fetchone()
+    conn.close()
+    if row is None:
+        return None
+    return json.loads(row[0], "UTF-8")
+
+
+def _cache_size(resource):
+    """
+    Returns the size in bytes of a cached response (0 if it isn't cached).
+    """
+    conn = sqlite3.connect(query_cache)
+    c = conn.cursor()
+    c.execute("SELECT length(CAST(value AS BLOB)) FROM queries WHERE resource = ?", (resource,))
+    row = c.fetchone()
+    conn.close()
+    if row is None:
+        return 0
+    return row[0]
+
+
+def _cache_put(resource, value):
+    conn = sqlite3.connect(query_cache)
+    conn.execute("INSERT OR REPLACE INTO queries VALUES (?, ?)", (resource, value))
+    conn.commit()
+    conn.close()
+
+
+def foursquare_get(path, params, read_cache=False, callback=None, priority=None):
+    """
+    Performs an HTTP get on PATH.
+    priority defaults to the one set for the calling thread (see scheduler.py).
+    If the API quota is running low, low priority requests are answered from
+    the cache (or with None) instead.
+    """
+    resource = _resource(path, params)
+    if priority is None:
+        priority = current_priority()
 
     print "-----"
     print "Getting " + resource
     print "Using cache: " + cacheModeToString(read_cache) + "..."
 
-    c = conn.cursor()
     if read_cache == CacheOrGet or read_cache == CacheOrNull:
-        c.execute("SELECT value FROM queries WHERE resource = ?", (resource,))
-        row = c.fetchone()
-        conn.close()
-        if row is None:
-            if read_cache == CacheOrGet:
-                return foursquare_get(path, params, NoCache, callback)
-            else:
-                return None
-        else:
-            response = json.loads(row[0], "UTF-8")
+        response = _cache_get(resource)
+        if response is None and read_cache == CacheOrGet:
+            return foursquare_get(path, params, NoCache, callback, priority)
+        return response
+
+    if not budget.allows(priority):
+        print "API quota running low; using cached data"
+        return _cache_get(resource)
+
+    budget.throttle(priority)
+    response_unparsed = _get(BASE_URL + resource, priority)
+    response = json.loads(response_unparsed, "UTF-8")
+
+    if "meta" in response and "errorType" in response["meta"]:
+        if response["meta"]["errorType"] == "rate_limit_exceeded":
+            budget.exhausted()
+            return _cache_get(resource)
+        response = None
+        # TODO: Show some sort of error to notify the user that foursquare seems to be down (use the provided message)
     else:
-        response_unparsed = urllib.urlopen(BASE_URL + resource).read()
-        response = json.loads(response_unparsed, "UTF-8")
-
-        if "meta" in response and "errorType" in response["meta"]:
-            response = None
-            # TODO: Show some sort of error to notify the user that foursquare seems to be down (use the provided message)
-        else:
-            c.execute("INSERT OR REPLACE INTO queries VALUES (?, ?)", (resource, response_unparsed))
-        conn.commit()
-
-    conn.close()
+        _cache_put(resource, response_unparsed)
 
     return response
 
 
-def foursquare_post(path, params):
+def foursquare_post(path, params, priority=None):
     commonParams = {'oauth_token': authData['ACCESS_TOKEN'], 'v': API_VERSION}
     allParams = dict(commonParams.items() + params.items())
     allParams = dict([k, v.encode('utf-8')] for k, v in allParams.items())
@@ -206,12 +340,61 @@ def foursquare_post(path, params):
 
     debug_json(allParams)
 
-    resource = urllib.urlopen(BASE_URL + path, allParams)
-    response = json.load(resource, "UTF-8")
+    response = scheduler.run(priority, _urlread, BASE_URL + path, allParams)
+    response = json.loads(response, "UTF-8")
     return response
 
 
-def image(path):
+class Posted:
+    """
+    What became of a write (see post_queued).
+    """
+    # foursquare accepted it
+    Delivered = 0
+    # It couldn't be sent (ie: there's no connectivity), and will be later on
+    Queued = 1
+    # foursquare refused it, and it was dropped
+    Rejected = 2
+    # It cancelled out an opposite toggle that was still queued (see outbox.py)
+    Cancelled = 3
+
+
+def post_queued(kind, path, params, key=None, state=None, extra=None):
+    """
+    Queues a write in the outbox and tries to send it (and anything queued
+    before it) right away.  Queued writes are sent in the background later
+    on.
+    Returns (outcome, response), where outcome is one of Posted's, and
+    response is foursquare's (None unless it was delivered or rejected).
+    """
+    itemId = outbox.enqueue(kind, path, params, key, state, extra)
+    if itemId is None:
+        return Posted.Cancelled, None
+    responses = outbox.flush(foursquare_post)
+    if outbox.depth() > 0:
+        outbox.start_flusher(foursquare_post)
+    response = responses.get(itemId)
+    if response is None:
+        return Posted.Queued, None
+    if response.get('meta', {}).get('code', 200) >= 400:
+        return Posted.Rejected, response
+    return Posted.Delivered, response
+
+
+def image(path, priority=None, retry=True):
+    """
+    Returns the local file for the image at path, downloading it first if
+    needed.  Images that just failed to download raise IOError right away
+    (see IMAGE_FAILURE_TTL).  retry must be off on the GUI thread, where
+    waiting between attempts would block painting.
+    """
+    return _fetch_image(path, priority, retry)[0]
+
+
+def _fetch_image(path, priority=None, retry=True):
+    """
+    Like image, but returns (localfile, bytes downloaded).
+    """
     url = urlparse(path)
     localdir = image_dir + os.path.dirname(url.path)
     localfile = image_dir + url.path
@@ -219,14 +402,27 @@ def image(path):
     if not os.path.exists(localdir):
         os.makedirs(localdir)
 
+    size = 0
     if not os.path.exists(localfile):
+        failed = image_failures.get(path)
+        if failed is not None and time.time() - failed < IMAGE_FAILURE_TTL:
+            raise IOError("couldn't download %s a moment ago" % path)
         print "Fetching image " + path + "..."
-        u = urllib.urlopen(path)
+        try:
+            if retry:
+                data = retry_policy.call(scheduler.run, priority, _urlread, path)
+            else:
+                data = scheduler.run(priority, _urlread, path)
+        except IOError:
+            image_failures[path] = time.time()
+            raise
+        image_failures.pop(path, None)
         f = open(localfile, "w")
-        f.write(u.read())
+        f.write(data)
         f.close()
+        size = len(data)
 
-    return localfile
+    return localfile, size
 
 #######################
 # AUXILIARY FUNCTIONS #
@@ -244,6 +440,56 @@ def build_venue_array(source):
         i += 1
     return venues
 
+
+def wrap_venues(source):
+    """
+    Builds a venue array out of a plain list of venues (ie: search results),
+    so that all lists have the same format.
+    """
+    return build_venue_array([{'venue': venue} for venue in source])
+
+
+def _remember_venues(venues):
+    """
+    Keeps a copy of every venue in a venue array in the local store, so
+    they can be looked up by id later (see stored_venue).
+    """
+    if venues:
+        store.venues_put([venues[i]['venue'] for i in range(len(venues))])
+    return venues
+
+
+def stored_venue(venueId):
+    """
+    Returns the last known (possibly compact) data for a venue that was in
+    any list, or None.
+    """
+    return store.venue(venueId)
+
+
+def join_venue_arrays(venues, more):
+    """
+    Returns a venue array with the venues in more after the ones in venues.
+    """
+    if not venues:
+        return more
+    joined = dict(venues)
+    for i in range(len(more)):
+        joined[len(venues) + i] = more[i]
+    return joined
+
+def merge_venue_arrays(venues, more):
+    """
+    Returns a venue array with the venues in more that aren't in venues
+    after the ones in venues.
+    """
+    if not venues:
+        return more
+    if not more:
+        return venues
+    ids = set([venues[i]['venue']['id'] for i in range(len(venues))])
+    return join_venue_arrays(venues, wrap_venues([more[i]['venue'] for i in range(len(more)) if more[i]['venue']['id'] not in ids]))
+
 ###############################################################################
 # All these method names need refactoring.  They should be similar to the foursquare API,
 # ie: calls to endpoint "user/$UID/tips" should be user_tips(uid)
@@ -252,31 +498,255 @@ def build_venue_array(source):
 # users.tips(uid)
 
 
-def get_history(read_cache):
-    response = foursquare_get("users/self/venuehistory", {}, read_cache)
-    if response:
-        return build_venue_array(response['response']['venues']['items'])
+def _pages(path, items, read_cache, limit=PAGE_SIZE, status=None):
+    """
+    Generator that fetches a long list one page at a time, using offset/limit.
+    items(response) should return the page's items and the list's total count.
+    Endpoints that ignore offset/limit just yield a single page.
+    If status (a dict) is given, status['complete'] is set once every page
+    has arrived; it isn't if a page couldn't be fetched.
+    """
+    offset = 0
+    while True:
+        response = foursquare_get(path, {'offset': offset, 'limit': limit}, read_cache)
+        if not response:
+            return
+        page, count = items(response['response'])
+        if page:
+            yield page
+        offset += len(page)
+        if len(page) < limit or offset >= count:
+            if status is not None:
+                status['complete'] = True
+            return
+
+
+def _all_pages(pages):
+    items = list()
+    for page in pages:
+        items.extend(page)
+    if items:
+        return build_venue_array(items)
+
+
+def _history_items(response):
+    return response['venues']['items'], response['venues']['count']
+
+
+def _history_item_pages(read_cache, full=False):
+    """
+    Yields the user's venue history, from the local history store.
+
+    When fetching, only activity newer than the last sync is downloaded and
+    merged into the store.  The whole history is downloaded only if full is
+    set, if there's nothing stored yet, or if the last full sync is too old.
+    """
+    if read_cache != ForceFetch:
+        items = store.history()
+        if items:
+            yield items
+            return
+        if read_cache == CacheOrNull:
+            return
+
+    now = int(time.time())
+    lastFull = store.sync_get("history_full")
+    since = store.sync_get("history_since")
+    if not full and (not lastFull or now - int(lastFull) > HISTORY_RESYNC_INTERVAL):
+        full = True
+    if not since or store.history_count() == 0:
+        full = True
+
+    # The next sync asks for what's newer than the newest visit we've seen;
+    # the device's clock may not agree with foursquare's
+    if full:
+        offset = 0
+        latest = 0
+        status = dict()
+        for page in _pages("users/self/venuehistory", _history_items, ForceFetch, status=status):
+            store.history_replace(page, now, offset)
+            offset += len(page)
+            latest = _latest_visit(page, latest)
+            yield page
+        # Venues not in the new download are only dropped if all of it
+        # arrived; otherwise, the old history is kept and it's tried again
+        if not status.get('complete'):
+            print "Couldn't download the whole history; keeping the stored one"
+            if offset == 0:
+                items = store.history()
+                if items:
+                    yield items
+            return
+        store.history_prune(now)
+        store.sync_set("history_full", now)
+        if latest:
+            store.sync_set("history_since", latest)
+        _forget_applied_checkins(latest)
+    else:
+        response = foursquare_get("users/self/venuehistory", {'afterTimestamp': since}, ForceFetch)
+        if response:
+            items = response['response']['venues']['items']
+            store.history_merge(_discount_applied_checkins(items, int(since)))
+            latest = _latest_visit(items, int(since))
+            if latest > int(since):
+                store.sync_set("history_since", latest)
+            _forget_applied_checkins(latest)
+        yield store.history()
+
+
+def _applied_checkins():
+    """
+    Returns the checkins that were applied to the stored history locally
+    (see _apply_checkin), and that a sync may not have come back with yet,
+    as [checkinId, venueId, createdAt] lists.
+    """
+    text = store.sync_get("applied_checkins")
+    if not text:
+        return []
+    return json.loads(text)
+
+
+def _set_applied_checkins(applied):
+    store.sync_set("applied_checkins", json.dumps(applied))
+
+
+def _discount_applied_checkins(items, since):
+    """
+    Returns venuehistory items for visits after since, with the checkins
+    already applied locally taken out of their visit counts, so that they
+    aren't counted twice.
+    """
+    counts = dict()
+    for checkinId, venueId, createdAt in _applied_checkins():
+        if createdAt > since:
+            counts[venueId] = counts.get(venueId, 0) + 1
+    if not counts:
+        return items
+    discounted = []
+    for item in items:
+        item = dict(item)
+        item['beenHere'] = max(item.get('beenHere', 0) - counts.get(item['venue']['id'], 0), 0)
+        discounted.append(item)
+    return discounted
+
+
+def _forget_applied_checkins(latest):
+    """
+    Forgets the checkins applied locally that a sync up to latest (the
+    newest visit it returned) has accounted for.
+    """
+    applied = _applied_checkins()
+    if applied:
+        _set_applied_checkins([item for item in applied if item[2] > latest])
+
+
+def _latest_visit(items, latest=0):
+    """
+    Returns the newest lastHereAt of venuehistory items (or latest, if it's
+    newer).
+    """
+    for item in items:
+        latest = max(latest, int(item.get('lastHereAt', 0)))
+    return latest
+
+
+def get_history_pages(read_cache, full=False):
+    for page in _history_item_pages(read_cache, full):
+        yield build_venue_array(page)
+
+
+def get_history(read_cache, full=False):
+    return _all_pages(_history_item_pages(read_cache, full))
+
+
+def resync_history():
+    """
+    Makes the next history refresh download the whole history again.
+    """
+    store.sync_del("history_full")
+
+
+def _todos_items(response):
+    return response['list']['listItems']['items'], response['list']['listItems']['count']
+
+
+def lists_todos_pages(read_cache):
+    for page in _pages("lists/self/todos", _todos_items, read_cache):
+        yield _remember_venues(build_venue_array(page))
 
 
 def lists_todos(read_cache):
-    response = foursquare_get("lists/self/todos", {}, read_cache)
-    if response:
-        return build_venue_array(response['response']['list']['listItems']['items'])
+    return _remember_venues(_all_pages(_pages("lists/self/todos", _todos_items, read_cache)))
 
 
-def venues_search(query, ll, category, limit, read_cache):
-    response = foursquare_get("venues/search", {'query': query, 'll': ll, 'intent': "checkin", 'categoryId': category, 'limit': limit}, read_cache)
+def venues_search(query, ll, category, limit, read_cache, offline=True):
+    """
+    Searches venues near ll.
+
+    Results are cached per geohash tile (see SEARCH_TILE_PRECISION),
+    category and query, so searching again from nearby is a hit; results of
+    a shorter query may also be filtered to answer a longer one.
+
+    If foursquare can't be reached and offline is set, the search is done
+    over the venues stored locally instead (see LocalStore.search), which
+    works for plain "nearby" searches too.
+    """
+    tile = None
+    origin = parse_ll(ll)
+    if origin is not None:
+        tile = geohash(origin[0], origin[1], SEARCH_TILE_PRECISION)
+
+    if read_cache != ForceFetch and tile:
+        cached = store.search_cache_get(tile, category or "", query, SEARCH_CACHE_AGE)
+        if cached is not None:
+            venues, exact = cached
+            if exact:
+                search_cache_stats['hits'] += 1
+            else:
+                search_cache_stats['prefix_hits'] += 1
+            return wrap_venues(venues)
+        search_cache_stats['misses'] += 1
+        if read_cache == CacheOrNull:
+            return None
+        read_cache = ForceFetch
+
+    try:
+        response = foursquare_get("venues/search", _search_params(query, ll, category, limit), read_cache)
+    except IOError:
+        if not offline:
+            raise
+        # Results for the tile, however old, beat a local search
+        cached = None
+        if tile:
+            cached = store.search_cache_get(tile, category or "", query)
+        if cached is not None:
+            print "foursquare can't be reached; using cached results"
+            return wrap_venues(cached[0])
+        print "foursquare can't be reached; searching locally"
+        venues = venues_search_local(query, ll, category, limit)
+        if not venues:
+            raise
+        return venues
     if response:
-        venues = dict()
-        i = 0
-        for venue in response['response']['venues']:
-            # Esto puede parecer cualquiera, pero es para que tenga el mismo formato que los dem&aacute;s, y sean todas las listas iguales
-            venues[i] = dict()
-            venues[i]['venue'] = venue
-            i += 1
+        venues = _remember_venues(wrap_venues(response['response']['venues']))
+        if tile:
+            store.search_cache_put(tile, category or "", query, response['response']['venues'],
+                                   len(response['response']['venues']) < int(limit))
         return venues
 
 
+def _search_params(query, ll, category, limit):
+    return {'query': query, 'll': ll, 'intent': "checkin", 'categoryId': category, 'limit': limit}
+
+
+def venues_search_local(query, ll, category, limit):
+    """
+    Searches the venues known locally (from history, todos, past searches,
+    etc), without any network access.
+    """
+    return wrap_venues(store.search(query, ll, category, limit))
+
+
 def get_user(uid, read_cache):
     """
     Returns profile information for a given user, including selected badges and mayorships.
@@ -292,12 +762,15 @@ def get_venue(venueId):
         return response['response']['venue']
 
 
-# TODO: make this entire file OO, and this an actual attribute of it
-checkin_hooks = list()
-def checkin(venue, ll, shout="", broadcast=None):
+
+
+from checkins import Checkin
+def checkin(checkin):
     """
     Checks in the user at venue with lat/lng ll
+    Returns (outcome, response), like post_queued.
     """
+    broadcast = checkin.broadcast
     if not broadcast:
         broadcast = config_get("broadcast")
         if broadcast == None:
@@ -305,58 +778,102 @@ def checkin(venue, ll, shout="", broadcast=None):
 
     print "Checking in with broadcast = " + broadcast
 
-    response = foursquare_post("/checkins/add", {'shout': shout, 'venueId': venue['id'], 'broadcast': broadcast, 'll': ll})
-
-    # This is, without doubt, the nastiest hack I've ever done!
-    print len(checkin_hooks)
-    for hook in checkin_hooks:
-        hook()
-    
-    return response
-
-
-from checkins import Checkin
-def checkin(checkin):
-	"""
-	Checks in the user at venue with lat/lng ll
-	"""
-	broadcast = checkin.broadcast
-	if not broadcast:
-		broadcast = config_get("broadcast")
-		if broadcast == None:
-			broadcast = BROADCAST_DEFAULT
-
-	print "Checking in with broadcast = " + broadcast
+    params = {'shout': checkin.text,
+              'venueId': checkin.venue['id'],
+              'broadcast': broadcast
+              }
+    # It's optional; there may have been no fix
+    if checkin.ll:
+        params['ll'] = checkin.ll
+    return post_queued("checkin", "/checkins/add", params)
 
-	params = { 'shout': checkin.text,
-	           'venueId': checkin.venue['id'],
-	           'broadcast': broadcast,
-	           'll': checkin.ll
-	           }
-	response = foursquare_post("/checkins/add", params)
 
-	# This is, without doubt, the nastiest hack I've ever done!
-	print len(checkin_hooks)
-	for hook in checkin_hooks:
-		hook()
-	
-	return response
-
-def add_checkin_hook(hook):
-    checkin_hooks.append(hook)
+def _apply_checkin(response):
+    """
+    Applies a checkin's response to the venue history, the last known
+    location and the cached self profile.  Returns False if the response
+    doesn't have all that's needed, or the profile isn't cached to patch.
+    """
+    checkin = response.get('response', {}).get('checkin')
+    if not checkin or 'venue' not in checkin or 'location' not in checkin['venue']:
+        return False
+    venue = checkin['venue']
+    result = CheckinResult.get(response)
+
+    def patch(cached):
+        user = cached['response']['user']
+        checkins = user.setdefault('checkins', {})
+        checkins['count'] = checkins.get('count', 0) + 1
+        checkins['items'] = [checkin] + checkins.get('items', [])[:PATCHED_CHECKINS - 1]
+        if result.badges:
+            badges = user.setdefault('badges', {})
+            badges['count'] = badges.get('count', 0) + len(result.badges)
+        if result.mayorshipType in ("new", "stolen"):
+            mayorships = user.setdefault('mayorships', {})
+            mayorships['count'] = mayorships.get('count', 0) + 1
+        return True
+
+    createdAt = int(checkin.get('createdAt', time.time()))
+    applied = _applied_checkins()
+    if checkin['id'] not in [checkinId for checkinId, venueId, at in applied]:
+        store.history_merge([{'venue': venue, 'beenHere': 1, 'lastHereAt': createdAt}])
+        # So that the next delta sync doesn't count it again
+        applied.append([checkin['id'], venue['id'], createdAt])
+        _set_applied_checkins(applied)
+
+    if 'lat' in venue['location']:
+        lat, lng = venue['location']['lat'], venue['location']['lng']
+        store.sync_set("last_ll", "%2.6f,%2.6f" % (lat, lng))
+        # Which is what the last checkin location provider reads first
+        config_set("last_ll", "%2.8f,%2.8f" % (lat, lng))
+
+    if not is_cached("users/self", {}):
+        return False
+    _patch_cache("resource", "users/self?%", patch)
+    return True
+
+
+def _revalidate_self(response):
+    set_priority(Priority.Background)
+    try:
+        get_user("self", ForceFetch)
+    except IOError, e:
+        print "Couldn't update self (%s)" % e
+    events.publish(CheckinDone(response))
+
+
+def _checkin_delivered(item, response):
+    if _apply_checkin(response):
+        events.publish(CheckinDone(response))
+    else:
+        # The response wasn't enough to update things locally
+        t = threading.Thread(target=_revalidate_self, args=(response,))
+        t.setDaemon(True)
+        t.start()
+outbox.on_delivered("checkin", _checkin_delivered)
 
 
-def get_last_ll():
+def get_last_ll(read_cache=CacheOrGet):
     """
-    Returns the ll of the user's last checkin
+    Returns the ll of the user's last checkin.  With CacheOrNull, that's
+    None unless it's known without asking foursquare.
     """
+    ll = store.sync_get("last_ll")
+    if ll:
+        return ll
+
+    user = get_user("self", read_cache)
+    if user is None:
+        return None
     ll = dict()
-    for item in get_user("self", False)['user']['checkins']['items']:
+    for item in user['user']['checkins'].get('items', []):
         if item['type'] == "checkin":
             ll['lat'] = item['venue']['location']['lat']
             ll['lng'] = item['venue']['location']['lng']
+            break
     if 'lat' in ll:
         ll = "%(lat)2.6f,%(lng)2.6f" % ll
+        store.sync_set("last_ll", ll)
     else:
         print "WARNING: no LL provided!"
         ll = "-34.596059,-58.398606"
@@ -367,12 +884,40 @@ def get_last_ll():
 def get_venues_categories(readCache=CacheOrGet):
     """
     Returns a hierarchical list of categories applied to venues.
+    Use get_category_tree instead, unless the raw tree is needed.
     """
+    global category_tree
+    if readCache not in (CacheOrGet, CacheOrNull):
+        # They may have changed; the tree is rebuilt next time it's needed
+        category_tree = None
+        store.sync_del("categories")
     response = foursquare_get("venues/categories", {}, readCache)
     if response:
         return response['response']['categories']
 
 
+def get_category_tree(readCache=CacheOrGet):
+    """
+    Returns the venue categories as a CategoryTree.  The tree is only built
+    once per categories version (ie: until they're fetched again); it's kept
+    in the local store, and in memory after the first call.
+    """
+    global category_tree
+    if category_tree is not None and readCache in (CacheOrGet, CacheOrNull):
+        return category_tree
+    stored = store.sync_get("categories")
+    if stored and readCache in (CacheOrGet, CacheOrNull) and stored.startswith(API_VERSION + "\n"):
+        category_tree = CategoryTree.loads(stored[len(API_VERSION) + 1:])
+        return category_tree
+    categories = get_venues_categories(readCache)
+    if categories is None:
+        return None
+    tree = CategoryTree.flatten(categories)
+    store.sync_set("categories", API_VERSION + "\n" + tree.dumps())
+    category_tree = tree
+    return tree
+
+
 def venue_add(venue, ignoreDuplicates=False, ignoreDuplicatesKey=None):
     """
     required: name, ll
@@ -380,6 +925,11 @@ def venue_add(venue, ignoreDuplicates=False, ignoreDuplicatesKey=None):
     second_run: ignoreDuplicates, ignoreDuplicatesKey
     """
     response = foursquare_post("venues/add", venue)
+    if 'venue' in response['response']:
+        store.venues_put([response['response']['venue']])
+        events.publish(VenueAdded(response['response']['venue']))
+    if 'candidateDuplicateVenues' in response['response']:
+        store.venues_put(response['response']['candidateDuplicateVenues'])
     return response
 
 
@@ -387,82 +937,272 @@ def venues_venue(venueId, readCache=CacheIfPosible):
     response = foursquare_get("venues/" + venueId, {}, readCache)
     if response:
         #response > venue > tips > groups [] > items [] >
+        if readCache != CacheOrNull:
+            store.venues_put([response['response']['venue']])
         return response['response']['venue']
 
 
+def _prefetch_venue(venueId):
+    if is_cached("venues/" + venueId, {}):
+        return 0
+    if not venues_venue(venueId, ForceFetch):
+        return None
+    # Other threads download at the same priority, so the scheduler's byte
+    # count can't tell what this fetch cost; the response just cached can.
+    return max(_cache_size(_resource("venues/" + venueId, {})), 1)
+
+
+def prefetch_venues(venueIds):
+    """
+    Fetches the full details of venues in the background, so that they're
+    cached by the time they're opened.  Only the last ids passed are fetched.
+    """
+    prefetcher.want(venueIds)
+
+
+def _prefetch_tile(tile):
+    lat, lng = geohash_center(tile)
+    ll = "%2.8f,%2.8f" % (lat, lng)
+    # Other threads download at the same priority, so what this costs is
+    # measured here rather than through the scheduler's byte count
+    fetched = store.search_cache_get(tile, "", "", SEARCH_CACHE_AGE) is None
+    venues = venues_search("", ll, "", DEFAULT_FETCH_AMOUNT, CacheOrGet, False)
+    if venues is None:
+        return None
+    size = 0
+    if fetched:
+        size = _cache_size(_resource("venues/search", _search_params("", ll, "", DEFAULT_FETCH_AMOUNT)))
+    for i in range(len(venues)):
+        for category in venues[i]['venue'].get('categories', [])[:1]:
+            try:
+                size += _fetch_image(category['icon']['prefix'] + "64" + category['icon']['name'])[1]
+            except IOError, e:
+                print "Couldn't prefetch icon (%s)" % e
+    return size
+
+
+def prefetch_area(ll):
+    """
+    Fetches, in the background, the venues around ll (and their category
+    icons), one search tile at a time, nearest first, so that searching
+    nearby works without a connection.  Tiles already cached aren't fetched
+    again.
+    """
+    origin = parse_ll(ll)
+    if origin is None:
+        return
+    area_prefetcher.want(geohash_tiles(origin[0], origin[1], AREA_PREFETCH_RADIUS, SEARCH_TILE_PRECISION))
+
+
 def users_leaderboard(read_cache):
     response = foursquare_get("users/leaderboard", {}, read_cache)
     if response:
         return response['response']['leaderboard']['items']
 
 
-def __delete_venue_with_tip(tipId):
+def _patch_cache(column, pattern, patch):
     """
-    A nasty hack.  If a tip changes status in a venue, I uncache the venue, since
-    the cached data is out-of-date, and manually synching this is pretty hard work
-    This may change if future </lie>
+    Rewrites cached responses in place.  patch(response) is called for every
+    cached response whose column ("resource" or "value") is LIKE pattern, and
+    must return whether it changed the response.
     """
     conn = sqlite3.connect(query_cache)
-    conn.execute("DELETE FROM queries WHERE value LIKE ?", ("%" + tipId + "%",))
+    c = conn.cursor()
+    c.execute("SELECT resource, value FROM queries WHERE " + column + " LIKE ?", (pattern,))
+    for resource, value in c.fetchall():
+        response = json.loads(value, "UTF-8")
+        if patch(response):
+            conn.execute("UPDATE queries SET value = ? WHERE resource = ?", (json.dumps(response), resource))
+    conn.commit()
+    conn.close()
+
+
+def _uncache(pattern):
+    conn = sqlite3.connect(query_cache)
+    conn.execute("DELETE FROM queries WHERE resource LIKE ?", (pattern,))
     conn.commit()
     conn.close()
 
 
+def _find_tips(node, tipId):
+    """
+    Yields every copy of a tip within a response.
+    """
+    if isinstance(node, dict):
+        if node.get('id') == tipId and 'text' in node:
+            yield node
+        for value in node.values():
+            for tip in _find_tips(value, tipId):
+                yield tip
+    elif isinstance(node, list):
+        for value in node:
+            for tip in _find_tips(value, tipId):
+                yield tip
+
+
+def _set_tip_listed(tip, groupType, marked):
+    """
+    Marks a tip (as in a response) as being in the user's todos or dones, and
+    updates its counter.  Returns whether it changed anything.
+    """
+    counter = {'todos': 'todo', 'dones': 'done'}[groupType]
+    groups = tip.setdefault('listed', {}).setdefault('groups', [])
+    listed = [group for group in groups if group.get('type') == groupType]
+    if bool(listed) == marked:
+        return False
+    if marked:
+        groups.append({'type': groupType, 'count': 1, 'items': []})
+    else:
+        for group in listed:
+            groups.remove(group)
+    count = tip.setdefault(counter, {}).get('count', 0)
+    if marked:
+        tip[counter]['count'] = count + 1
+    else:
+        tip[counter]['count'] = max(count - 1, 0)
+    return True
+
+
+def _mark_tip_cached(tipId, groupType, marked):
+    def patch(response):
+        changed = False
+        for tip in list(_find_tips(response, tipId)):
+            changed = _set_tip_listed(tip, groupType, marked) or changed
+        return changed
+    _patch_cache("value", "%" + tipId + "%", patch)
+
+    if groupType == "todos" and not marked:
+        def remove(response):
+            listItems = response['response']['list']['listItems']
+            items = [item for item in listItems.get('items', []) if item.get('tip', {}).get('id') != tipId]
+            if len(items) == len(listItems.get('items', [])):
+                return False
+            listItems['count'] = max(listItems.get('count', 0) - (len(listItems['items']) - len(items)), 0)
+            listItems['items'] = items
+            return True
+        _patch_cache("resource", "lists/self/todos?%", remove)
+
+
+def _tip_toggle_delivered(item, response):
+    if not item.extra:
+        return
+    if item.state and item.extra['group'] == "todos" and 'todo' in response['response']:
+        todo = response['response']['todo']
+        tip = todo.get('tip', {})
+        if 'venue' not in tip:
+            return
+        listItem = {'id': todo['id'], 'createdAt': todo.get('createdAt'), 'tip': tip, 'venue': tip['venue']}
+
+        def insert(response):
+            listItems = response['response']['list']['listItems']
+            if [i for i in listItems.get('items', []) if i.get('tip', {}).get('id') == tip['id']]:
+                return False
+            listItems.setdefault('items', []).insert(0, listItem)
+            listItems['count'] = listItems.get('count', 0) + 1
+            return True
+        _patch_cache("resource", "lists/self/todos?%offset=0%", insert)
+
+
+def _tip_toggle_failed(item, response):
+    if not item.extra:
+        return
+    _mark_tip_cached(item.extra['tipId'], item.extra['group'], not item.state)
+    if item.extra['group'] == "todos" and not item.state:
+        # The removed todo can't be put back; the list will be fetched again.
+        _uncache("lists/self/todos?%")
+outbox.on_delivered("marktodo", _tip_toggle_delivered)
+outbox.on_failed("marktodo", _tip_toggle_failed)
+outbox.on_delivered("markdone", _tip_toggle_delivered)
+outbox.on_failed("markdone", _tip_toggle_failed)
+
+
+def _tip_delivered(item, response):
+    tip = response['response'].get('tip')
+    if not tip:
+        return
+
+    def insert(response):
+        tips = response['response']['venue'].setdefault('tips', {'count': 0, 'groups': []})
+        if list(_find_tips(tips, tip['id'])):
+            return False
+        if not tips.setdefault('groups', []):
+            tips['groups'].append({'type': "others", 'name': "Tips from others", 'count': 0, 'items': []})
+        group = tips['groups'][0]
+        group.setdefault('items', []).insert(0, tip)
+        group['count'] = group.get('count', 0) + 1
+        tips['count'] = tips.get('count', 0) + 1
+        return True
+    _patch_cache("resource", "venues/" + item.params['venueId'] + "?%", insert)
+    events.publish(TipAdded(item.params['venueId'], tip))
+outbox.on_delivered("tip", _tip_delivered)
+
+
 def tip_add(venueId, text, url=""):
+    """
+    Leaves a tip.  Once it's delivered, it's added to the cached venue.
+    Returns (outcome, response), like post_queued.
+    """
     broadcast = config_get("broadcast")
     if broadcast == None:
         broadcast = BROADCAST_DEFAULT
 
-    response = foursquare_post("/tips/add", {'venueId': venueId, 'text': text, 'url': url, 'broadcast': broadcast})
-    return response
+    return post_queued("tip", "/tips/add", {'venueId': venueId, 'text': text, 'url': url, 'broadcast': broadcast})
 
 
 def tip_marktodo(tipId, marked):
+    """
+    Marks (or unmarks) a tip as to-do.  Cached responses are patched right
+    away, and patched back if foursquare rejects the change.
+    """
+    _mark_tip_cached(tipId, "todos", marked)
+    extra = {'tipId': tipId, 'group': "todos"}
     if marked:
-        response = foursquare_post("tips/" + tipId + "/marktodo", {})
+        return post_queued("marktodo", "tips/" + tipId + "/marktodo", {}, "todo:" + tipId, 1, extra)
     else:
-        response = foursquare_post("lists/self/todos/deleteitem", {'itemId': tipId})
-    __delete_venue_with_tip(tipId)
-    return response
+        return post_queued("marktodo", "lists/self/todos/deleteitem", {'itemId': tipId}, "todo:" + tipId, 0, extra)
 
 
 def tip_markdone(tipId, marked):
+    """
+    Marks (or unmarks) a tip as done, like tip_marktodo.
+    """
+    _mark_tip_cached(tipId, "dones", marked)
+    extra = {'tipId': tipId, 'group': "dones"}
     if marked:
-        response = foursquare_post("tips/" + tipId + "/markdone", {})
+        return post_queued("markdone", "tips/" + tipId + "/markdone", {}, "done:" + tipId, 1, extra)
     else:
-        response = foursquare_post("lists/self/dones/deleteitem", {'itemId': tipId})
-    __delete_venue_with_tip(tipId)
-    return response
+        return post_queued("markdone", "lists/self/dones/deleteitem", {'itemId': tipId}, "done:" + tipId, 0, extra)
 
 def user_mayorships(userId, read_cache):
     response = foursquare_get("users/" + userId + "/mayorships", {}, read_cache)
     if response:
-        return build_venue_array(response['response']['mayorships']['items'])
+        return _remember_venues(build_venue_array(response['response']['mayorships']['items']))
 
 ############################
 # Extra one-time functions #
 ############################
 
 
-def fetch_category_image(category):
-    prefix = category['icon']['prefix']
-    extension = category['icon']['name']
-    image(prefix + "64" + extension)
-    if 'categories' in category:
-        for category in category['categories']:
-            fetch_category_image(category)
-
-
 def init_category_icon_cache():
-    categories = get_venues_categories(ForceFetch)
-    for category in categories:
-        fetch_category_image(category)
+    for category in get_category_tree(ForceFetch).categories():
+        image(category.icon())
     print "done updating image cache"
 
 
 def init():
     authData['CODE'] = config_get("code")
     authData['ACCESS_TOKEN'] = config_get("access_token")
+    hedger.enabled = config_get("hedging") == "true"
+    if config_get("prefetch_requests"):
+        prefetcher.max_requests = int(config_get("prefetch_requests"))
+    if config_get("prefetch_bytes"):
+        prefetcher.max_bytes = int(config_get("prefetch_bytes"))
+    if config_get("area_prefetch_requests"):
+        area_prefetcher.max_requests = int(config_get("area_prefetch_requests"))
+    if config_get("area_prefetch_bytes"):
+        area_prefetcher.max_bytes = int(config_get("area_prefetch_bytes"))
+    if authData['ACCESS_TOKEN'] and outbox.depth() > 0:
+        outbox.start_flusher(foursquare_post)
 
 if __name__ == "__main__":
     print "This is the foursquare API library, yo're not supposed to run this!"
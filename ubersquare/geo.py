@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012 Hugo Osvaldo Barrera <hugo@osvaldobarrera.com.ar>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import math
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EARTH_RADIUS = 6371000.0
+
+
+def parse_ll(ll):
+    """
+    Returns (lat, lng) for an "lat,lng" string, or None.
+    """
+    if not ll:
+        return None
+    try:
+        lat, lng = ll.split(",")
+        return float(lat), float(lng)
+    except ValueError:
+        return None
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """
+    Returns the distance in metres between two points.
+    """
+    return distances(lat1, lng1, [lat2], [lng2])[0]
+
+
+def distances(lat, lng, lats, lngs):
+    """
+    Returns the distances in metres from (lat, lng) to every point in
+    lats/lngs, all in one batch.
+
+    Uses an equirectangular projection, which is more than accurate enough
+    at the distances venues are apart.
+    """
+    if not lats:
+        return []
+    if numpy is not None:
+        lats = numpy.radians(numpy.asarray(lats, dtype=float))
+        lngs = numpy.radians(numpy.asarray(lngs, dtype=float))
+        lat = math.radians(lat)
+        lng = math.radians(lng)
+        x = (lngs - lng) * numpy.cos((lats + lat) / 2)
+        y = lats - lat
+        return (numpy.sqrt(x * x + y * y) * EARTH_RADIUS).astype(int).tolist()
+
+    radians = math.radians
+    cos = math.cos
+    sqrt = math.sqrt
+    lat = radians(lat)
+    lng = radians(lng)
+    result = []
+    append = result.append
+    for lat2, lng2 in zip(lats, lngs):
+        lat2 = radians(lat2)
+        x = (radians(lng2) - lng) * cos((lat2 + lat) / 2)
+        y = lat2 - lat
+        append(int(sqrt(x * x + y * y) * EARTH_RADIUS))
+    return result
+
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash(lat, lng, precision=9):
+    """
+    Returns the geohash of a point.  Points in the same cell share a prefix,
+    so cells can be looked up as string ranges.
+    """
+    latRange = [-90.0, 90.0]
+    lngRange = [-180.0, 180.0]
+    result = []
+    bits = 0
+    bit = 0
+    even = True
+    while len(result) < precision:
+        if even:
+            middle = (lngRange[0] + lngRange[1]) / 2
+            if lng >= middle:
+                bits = bits * 2 + 1
+                lngRange[0] = middle
+            else:
+                bits = bits * 2
+                lngRange[1] = middle
+        else:
+            middle = (latRange[0] + latRange[1]) / 2
+            if lat >= middle:
+                bits = bits * 2 + 1
+                latRange[0] = middle
+            else:
+                bits = bits * 2
+                latRange[1] = middle
+        even = not even
+        bit += 1
+        if bit == 5:
+            result.append(_BASE32[bits])
+            bits = 0
+            bit = 0
+    return "".join(result)
+
+
+def geohash_cell(precision):
+    """
+    Returns the (height, width) in degrees of geohash cells of a precision.
+    """
+    bits = 5 * precision
+    return 180.0 / (1 << (bits / 2)), 360.0 / (1 << (bits - bits / 2))
+
+
+def geohash_cover(south, west, north, east, max_cells=16):
+    """
+    Returns the geohash prefixes of the cells that cover a bounding box,
+    using the finest precision that needs at most max_cells cells.
+    """
+    for precision in range(9, 0, -1):
+        height, width = geohash_cell(precision)
+        rows = int((north - south) / height) + 2
+        columns = int((east - west) / width) + 2
+        if rows * columns > max_cells * 4 and precision > 1:
+            continue
+        cells = set()
+        lat = south
+        while True:
+            lng = west
+            while True:
+                cells.add(geohash(lat, lng, precision))
+                if lng >= east:
+                    break
+                lng = min(lng + width, east)
+            if lat >= north:
+                break
+            lat = min(lat + height, north)
+        if len(cells) <= max_cells or precision == 1:
+            return sorted(cells)
+
+
+def geohash_center(hash):
+    """
+    Returns (lat, lng) of the center of a geohash cell.
+    """
+    latRange = [-90.0, 90.0]
+    lngRange = [-180.0, 180.0]
+    even = True
+    for c in hash:
+        bits = _BASE32.index(c)
+        for shift in range(4, -1, -1):
+            if even:
+                r = lngRange
+            else:
+                r = latRange
+            middle = (r[0] + r[1]) / 2
+            if bits & (1 << shift):
+                r[0] = middle
+            else:
+                r[1] = middle
+            even = not even
+    return (latRange[0] + latRange[1]) / 2, (lngRange[0] + lngRange[1]) / 2
+
+
+def geohash_tiles(lat, lng, metres, precision):
+    """
+    Returns the geohash cells of a precision within metres of a point,
+    nearest first.
+    """
+    south, west, north, east = bounding_box(lat, lng, metres)
+    height, width = geohash_cell(precision)
+    tiles = dict()
+    y = south
+    while y < north + height:
+        x = west
+        while x < east + width:
+            tile = geohash(min(y, north), min(x, east), precision)
+            if tile not in tiles:
+                center = geohash_center(tile)
+                tiles[tile] = distance(lat, lng, center[0], center[1])
+            x += width
+        y += height
+    return sorted(tiles.keys(), key=lambda tile: tiles[tile])
+
+
+def bounding_box(lat, lng, metres):
+    """
+    Returns (south, west, north, east) of a box of metres around a point.
+    """
+    dLat = math.degrees(metres / EARTH_RADIUS)
+    dLng = math.degrees(metres / (EARTH_RADIUS * max(math.cos(math.radians(lat)), 0.01)))
+    return max(lat - dLat, -90.0), max(lng - dLng, -180.0), min(lat + dLat, 90.0), min(lng + dLng, 180.0)
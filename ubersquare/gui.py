@@ -25,9 +25,11 @@ import foursquare_auth
 from venues import NewVenueWindow, VenueListWindow
 from foursquare import Cache
 from locationProviders import LocationProviderSelector, LocationProvider
-from threads import VenueProviderThread, UserUpdaterThread, ImageCacheThread, UpdateSelf, VenueSearchThread
-from custom_widgets import SignalEmittingValueButton, CategorySelector, UberSquareWindow, Title, Ruler
+from threads import VenuePagesThread, UserUpdaterThread, ImageCacheThread, UpdateSelf, VenueSearchThread
+from custom_widgets import SignalEmittingValueButton, CategorySelector, UberSquareWindow, Title, Ruler, EventDispatcher
 from users import UserListWindow
+from objects import User
+from events import CheckinDone
 from about import AboutDialog
 from datetime import datetime
 
@@ -42,13 +44,7 @@ class Profile(QWidget):
         self.textLabel.setWordWrap(True)
         self.__updateInfo(True)
 
-        name = ""
-        if 'firstName' in self.user:
-            name += self.user['firstName'] + " "
-        if 'lastName' in self.user:
-            name += self.user['lastName']
-
-        self.nameTitle = Title(name)
+        self.nameTitle = Title(User.get(self.user).name)
 
         profileLayout = QGridLayout()
         self.setLayout(profileLayout)
@@ -65,7 +61,7 @@ class Profile(QWidget):
         selfUpdated = Signal()
         self.connect(self, SIGNAL("selfUpdated()"), self.__updateInfo)
 
-        foursquare.add_checkin_hook(self.checkin)
+        foursquare.events.subscribe(CheckinDone, self.checkin)
 
     def __clicked(self):
         t = UpdateSelf(self)
@@ -76,9 +72,9 @@ class Profile(QWidget):
     def mousePressEvent(self, event):
         self.clicked.emit()
 
-    def checkin(self):
-        t = UpdateSelf(self)
-        t.start()
+    def checkin(self, event):
+        # The cached profile has already been updated with the checkin
+        self.__updateInfo()
 
     def __updateInfo(self, initial=False):
         if not initial:
@@ -87,9 +83,10 @@ class Profile(QWidget):
             QMaemo5InformationBox.information(self, "Stats updated!", 1500)
             self.manualUpdate = False
 
-        badges = "<b>" + str(self.user['badges']['count']) + "</b> badges"
-        mayorships = "<b>" + str(self.user['mayorships']['count']) + "</b> mayorships"
-        checkins = "<b>" + str(self.user['checkins']['count']) + "</b> checkins"
+        user = User.get(self.user)
+        badges = "<b>" + str(user.badgesCount) + "</b> badges"
+        mayorships = "<b>" + str(user.mayorshipsCount) + "</b> mayorships"
+        checkins = "<b>" + str(user.checkinsCount) + "</b> checkins"
 
         if 'items' in self.user['checkins']:
             location = self.user['checkins']['items'][0]['venue']['name']
@@ -101,13 +98,19 @@ class Profile(QWidget):
 
 
         text = location + "<br>" + badges + " | " + mayorships + " | " + checkins
+        pending = foursquare.outbox.depth()
+        if pending > 0:
+            text += "<br><i>" + str(pending) + " update(s) waiting to be sent</i>"
         self.textLabel.setText(text)
 
-        self.photo = QImage(foursquare.image(self.user['photo']))
+        self.photo = QImage(foursquare.image(user.photo))
         self.photo_label.setPixmap(QPixmap(self.photo))
 
 
 class MainWindow(UberSquareWindow):
+    # How often to prefetch the venues around the current location, in milliseconds
+    AREA_PREFETCH_INTERVAL = 5 * 60 * 1000
+
     def __init__(self):
         super(MainWindow, self).__init__(None)
         self.setAttribute(Qt.WA_Maemo5ShowProgressIndicator, True)
@@ -192,6 +195,29 @@ class MainWindow(UberSquareWindow):
         showSearchResults = Signal()
         self.connect(self, SIGNAL("showSearchResults()"), self.__showSearchResults)
 
+        # The search waiting for a location (see search_venues_pushed)
+        self.__search = None
+        locationFound = Signal()
+        self.connect(self, SIGNAL("locationFound()"), self.__searchVenues)
+
+        self.areaTimer = QTimer(self)
+        self.areaTimer.setInterval(MainWindow.AREA_PREFETCH_INTERVAL)
+        self.areaTimer.timeout.connect(self.prefetchArea)
+        self.areaTimer.start()
+        QTimer.singleShot(0, self.prefetchArea)
+
+    def prefetchArea(self):
+        """
+        Prefetches the venues around wherever we are now, so that nearby
+        searches work with no connectivity later on.
+        """
+        # Off the GUI thread, and without asking foursquare where we are
+        LocationProvider().locate(self.__prefetchArea, offline=True)
+
+    def __prefetchArea(self, fix):
+        if fix is not None:
+            foursquare.prefetch_area(fix.ll)
+
     def imageCache_pushed(self):
         c = QMessageBox(self)
         c.setWindowTitle("Update image cache?")
@@ -216,6 +242,10 @@ class MainWindow(UberSquareWindow):
         about.setText("About")
         self.connect(about, SIGNAL("triggered()"), self.__showAbout)
 
+        resync = QAction(self)
+        resync.setText("Re-download history")
+        self.connect(resync, SIGNAL("triggered()"), self.__resyncHistory)
+
         #settings = QAction(self)
         #settings.setText("Settings")
 
@@ -223,11 +253,16 @@ class MainWindow(UberSquareWindow):
         self.setMenuBar(menubar)
 
         #menubar.addAction(settings)
+        menubar.addAction(resync)
         menubar.addAction(about)
 
     def __showAbout(self):
         AboutDialog().exec_()
 
+    def __resyncHistory(self):
+        foursquare.resync_history()
+        QMaemo5InformationBox.information(self, "The whole history will be downloaded next time it's opened")
+
     def leaderboard_button_pushed(self):
         users = foursquare.users_leaderboard(foursquare.CacheOrNull)
         w = UserListWindow("Leaderboard", users, self)
@@ -251,7 +286,7 @@ class MainWindow(UberSquareWindow):
         venues = foursquare.get_history(foursquare.CacheOrNull)
         if not self._previous_venues:
             self._previous_venues = VenueListWindow("Visited Venues", venues, self)
-        t = VenueProviderThread(self._previous_venues, foursquare.get_history, self)
+        t = VenuePagesThread(self._previous_venues, foursquare.get_history_pages, self, not venues)
         t.start()
         if venues:
             self._previous_venues.show()
@@ -263,7 +298,7 @@ class MainWindow(UberSquareWindow):
             venues = foursquare.lists_todos(foursquare.CacheOrNull)
             if not self._todo_venues:
                 self._todo_venues = VenueListWindow("To-Do Venues", venues, self)
-            t = VenueProviderThread(self._todo_venues, foursquare.lists_todos, self)
+            t = VenuePagesThread(self._todo_venues, foursquare.lists_todos_pages, self, not venues)
             t.start()
             if venues:
                 self._todo_venues.show()
@@ -278,14 +313,38 @@ class MainWindow(UberSquareWindow):
         if (self.searchDialog.result() != QDialog.Accepted):
             return None
 
-        venueName = self.searchDialog.text().encode('utf-8')
-        categoryId = self.searchDialog.category()
-        ll = LocationProvider().get_ll()
+        self.__search = (self.searchDialog.text().encode('utf-8'), self.searchDialog.category(), None)
+        # Finding a fix may take a while
+        self.showWaitingDialog.emit()
+        LocationProvider().locate(self.__located)
+
+    def __located(self, fix):
+        # May be called from a background thread (see LocationProvider.locate)
+        venueName, categoryId, ll = self.__search
+        if fix is not None:
+            ll = fix.ll
+        self.__search = (venueName, categoryId, ll)
+        self.locationFound.emit()
+
+    def __searchVenues(self):
+        venueName, categoryId, ll = self.__search
+        self.hideWaitingDialog.emit()
+        if ll is None:
+            QMaemo5InformationBox.information(self, "No location available, so there's nowhere to search around. Try again in a while.")
+            return
 
         try:
+            # Venues seen before are shown right away, and foursquare's
+            # results are merged in once they arrive
+            local = foursquare.venues_search_local(venueName, ll, categoryId, foursquare.DEFAULT_FETCH_AMOUNT)
             venues = foursquare.venues_search(venueName, ll, categoryId, foursquare.DEFAULT_FETCH_AMOUNT, foursquare.CacheOrNull)
+            venues = foursquare.merge_venue_arrays(venues, local)
             v = VenueListWindow("Search results", venues, self)
-            t = VenueSearchThread(v, foursquare.venues_search, venueName, ll, categoryId, foursquare.DEFAULT_FETCH_AMOUNT, self)
+            v.enableLiveSearch(
+                lambda text: foursquare.venues_search(text.encode('utf-8'), ll, categoryId, foursquare.DEFAULT_FETCH_AMOUNT, foursquare.CacheOrGet),
+                lambda text: foursquare.venues_search_local(text.encode('utf-8'), ll, categoryId, foursquare.DEFAULT_FETCH_AMOUNT),
+                venues)
+            t = VenueSearchThread(v, foursquare.venues_search, venueName, ll, categoryId, foursquare.DEFAULT_FETCH_AMOUNT, self, local)
             t.start()
             if venues:
                 v.show()
@@ -297,20 +356,15 @@ class MainWindow(UberSquareWindow):
     def locationSelected(self, index):
         LocationProvider().select(index)
         foursquare.config_set("locationProvider", index)
+        self.prefetchArea()
 
     def new_venue_pushed(self):
         try:
-            w = NewVenueWindow(self, foursquare.get_venues_categories(), LocationProvider().get_ll())
+            w = NewVenueWindow(self, LocationProvider().get_ll())
             w.show()
         except IOError:
             self.networkError.emit()
 
-    def setVenues(self, venues):
-        self.__venues = venues
-
-    def venues(self):
-        return self.__venues
-
     def setUsers(self, venues):
         self.__users = venues
 
@@ -398,6 +452,7 @@ class SearchDialog(QDialog):
 
 def start():
     app = QApplication(sys.argv)
+    dispatcher = EventDispatcher(foursquare.events)
 
     token_present = foursquare.config_get("access_token") != None
 
@@ -15,10 +15,64 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 import location
+import threading
+import time
 import foursquare
 from PySide.QtCore import QAbstractListModel, Qt
 from PySide.QtMaemo5 import QMaemo5ListPickSelector
 
+# A fix this recent (in seconds) and accurate (in metres) is used right away
+FIX_MAX_AGE = 60
+FIX_ACCURACY = 100
+# How long to wait for a good enough fix, in seconds
+FIX_TIMEOUT = 15
+# How often to look for a better fix meanwhile, in seconds
+FIX_POLL_INTERVAL = 0.5
+
+
+class Fix:
+	"""
+	A location: ll ("lat,lng"), its accuracy in metres (None if unknown),
+	and when it was taken, in seconds since the epoch.
+	"""
+	def __init__(self, ll, accuracy=None, timestamp=None):
+		self.ll = ll
+		self.accuracy = accuracy
+		if timestamp is None:
+			timestamp = time.time()
+		self.timestamp = timestamp
+
+	def age(self):
+		return max(time.time() - self.timestamp, 0)
+
+	def good_enough(self, max_age, accuracy):
+		return self.age() <= max_age and (self.accuracy is None or self.accuracy <= accuracy)
+
+	def better_than(self, other):
+		if other is None:
+			return True
+		if self.accuracy != other.accuracy:
+			return other.accuracy is None or (self.accuracy is not None and self.accuracy < other.accuracy)
+		return self.timestamp > other.timestamp
+
+
+def _device_fix(device):
+	"""
+	Returns the fix a location.GPSDevice has right now, or None.
+	"""
+	fix = device.fix
+	# fix[0] is the mode: 2 and 3 are 2D and 3D fixes; NaN means unknown
+	if not fix or fix[0] < 2 or fix[4] != fix[4] or fix[5] != fix[5]:
+		return None
+	accuracy = None
+	if fix[6] == fix[6]:
+		# The horizontal accuracy comes in centimetres
+		accuracy = fix[6] / 100.0
+	timestamp = None
+	if fix[2] == fix[2] and fix[2] > 0:
+		timestamp = fix[2]
+	return Fix("%2.8f,%2.8f" % (fix[4], fix[5]), accuracy, timestamp)
+
 
 class LocationProviderModel(QAbstractListModel):
 	def __init__(self):
@@ -61,6 +115,8 @@ class LocationProvider:
 	__we_are_one = {}
 	__providers = []
 	__selectedProvider = None
+	# The last fix found by fix(), for providers whose fixes can be reused
+	__lastFix = None
 
 	def init(self):
 		self.register(AGPSLocationProvider())
@@ -88,18 +144,82 @@ class LocationProvider:
 			return None
 		return self.__selectedProvider.get_ll(venue)
 
+	def cached_fix(self):
+		"""
+		Returns the last fix found (see fix), or None.  It never blocks, but
+		the fix may be old; check its age().
+		"""
+		return self.__lastFix
+
+	def fix(self, venue=None, max_age=FIX_MAX_AGE, accuracy=FIX_ACCURACY, timeout=FIX_TIMEOUT, offline=False):
+		"""
+		Returns a fix from the selected provider: the last one, if it's good
+		enough, or else the best one it gets within timeout seconds (None if
+		it gets none at all).  If offline is set, providers don't ask
+		foursquare for anything.  This blocks; from the GUI thread, use locate.
+		"""
+		provider = self.__selectedProvider
+		if not provider:
+			return None
+		best = self.__lastFix
+		deadline = time.time() + timeout
+		while best is None or not best.good_enough(max_age, accuracy):
+			try:
+				fix = provider.get_fix(venue, offline)
+			except IOError, e:
+				print "Couldn't get a location (%s)" % e
+				fix = None
+			if fix is not None and fix.better_than(best):
+				best = fix
+			if time.time() >= deadline:
+				break
+			if best is None or not best.good_enough(max_age, accuracy):
+				time.sleep(FIX_POLL_INTERVAL)
+		if best is not None and provider.reusable and provider is self.__selectedProvider:
+			self.__lastFix = best
+		return best
+
+	def locate(self, callback, venue=None, max_age=FIX_MAX_AGE, accuracy=FIX_ACCURACY, timeout=FIX_TIMEOUT, offline=False):
+		"""
+		Calls callback(fix) (see fix).  If the last fix is good enough, that's
+		done right away; otherwise, it's called from a background thread once
+		a fix is found or timeout runs out.  callback is always called, with
+		None if looking the location up failed.
+		"""
+		cached = self.__lastFix
+		if cached is not None and cached.good_enough(max_age, accuracy):
+			callback(cached)
+			return
+
+		def run():
+			fix = None
+			try:
+				fix = self.fix(venue, max_age, accuracy, timeout, offline)
+			finally:
+				callback(fix)
+		t = threading.Thread(target=run)
+		t.setDaemon(True)
+		t.start()
+
 	def select(self, index):
 		if self.__selectedProvider:
 			self.__selectedProvider.unselect()
 		self.__selectedProvider = self.get(index)
+		self.__lastFix = None
 		self.__selectedProvider.select()
 
 
 class AGPSLocationProvider:
+	# Fixes don't depend on the venue, so the last one can be used again
+	reusable = True
+
 	def __init__(self):
 		self.control = location.GPSDControl.get_default()
 		self.device = location.GPSDevice()
 
+	def get_fix(self, venue=None, offline=False):
+		return _device_fix(self.device)
+
 	def get_ll(self, venue=None):
 		lat = "%2.8f" % self.device.fix[4]
 		lng = "%2.8f" % self.device.fix[5]
@@ -117,10 +237,20 @@ class AGPSLocationProvider:
 
 
 class LastCheckinLocationProvider:
-	def get_ll(self, venue=None):
+	reusable = False
+
+	def get_fix(self, venue=None, offline=False):
+		ll = self.get_ll(venue, offline)
+		if ll:
+			return Fix(ll)
+
+	def get_ll(self, venue=None, offline=False):
 		ll = foursquare.config_get("last_ll")
 		if not ll:
-			ll = foursquare.get_last_ll()
+			if offline:
+				ll = foursquare.get_last_ll(foursquare.CacheOrNull)
+			else:
+				ll = foursquare.get_last_ll()
 		if venue:
 			lat = "%2.8f" % venue['location']['lat']
 			lng = "%2.8f" % venue['location']['lng']
@@ -138,9 +268,16 @@ class LastCheckinLocationProvider:
 
 
 class AproximateVenueLocationProvider:
-	def get_ll(self, venue=None):
+	reusable = False
+
+	def get_fix(self, venue=None, offline=False):
+		ll = self.get_ll(venue, offline)
+		if ll:
+			return Fix(ll)
+
+	def get_ll(self, venue=None, offline=False):
 		if not venue:
-			return LastCheckinLocationProvider().get_ll()
+			return LastCheckinLocationProvider().get_ll(None, offline)
 		venueId = venue['id']
 		lat = float((ord(venueId[0]) + (ord(venueId[1]) * 100))) / (10000 * 10000) + venue['location']['lat']
 		lat = "%2.8f" % lat
@@ -161,10 +298,15 @@ class AproximateVenueLocationProvider:
 
 
 class CellTowerProvider:
+	reusable = True
+
 	def __init__(self):
 		self.control = location.GPSDControl.get_default()
 		self.device = location.GPSDevice()
 
+	def get_fix(self, venue=None, offline=False):
+		return _device_fix(self.device)
+
 	def get_ll(self, venue=None):
 		lat = "%2.8f" % self.device.fix[4]
 		lng = "%2.8f" % self.device.fix[5]
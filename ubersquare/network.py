@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012 Hugo Osvaldo Barrera <hugo@osvaldobarrera.com.ar>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import threading
+import random
+import time
+import sys
+
+
+class RetryableError(IOError):
+    """
+    Raised for responses that are worth retrying (ie: 503s).
+    retry_after is the number of seconds the server asked us to wait, if any.
+    """
+    def __init__(self, message, retry_after=None):
+        IOError.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class RetryPolicy:
+    """
+    Retries idempotent requests that failed with an IOError, waiting an
+    exponentially growing, randomized ("full jitter") amount of time between
+    attempts.  A server-provided Retry-After is always honoured.
+    """
+
+    def __init__(self, attempts=3, base=0.5, cap=8.0):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.retries = 0
+
+    def delay(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.cap, self.base * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, function, *args):
+        attempt = 0
+        while True:
+            try:
+                return function(*args)
+            except IOError, e:
+                attempt += 1
+                if attempt >= self.attempts:
+                    raise
+                self.retries += 1
+                delay = self.delay(attempt, getattr(e, 'retry_after', None))
+                print "Request failed (%s), retrying in %.1fs" % (e, delay)
+                time.sleep(delay)
+
+
+class LatencyStats:
+    """
+    Keeps the last few latency samples, to calculate percentiles.
+    """
+
+    def __init__(self, size=200):
+        self.size = size
+        self.__samples = []
+        self.__lock = threading.Lock()
+
+    def add(self, latency):
+        self.__lock.acquire()
+        try:
+            self.__samples.append(latency)
+            if len(self.__samples) > self.size:
+                del self.__samples[0]
+        finally:
+            self.__lock.release()
+
+    def __len__(self):
+        return len(self.__samples)
+
+    def percentile(self, p):
+        self.__lock.acquire()
+        try:
+            samples = sorted(self.__samples)
+        finally:
+            self.__lock.release()
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * p / 100.0))
+        return samples[index]
+
+
+class _Attempt(threading.Thread):
+    def __init__(self, function, args, done, hedger, primary):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.function = function
+        self.args = args
+        self.done = done
+        self.hedger = hedger
+        self.primary = primary
+        self.result = None
+        self.error = None
+        self.finished = False
+
+    def run(self):
+        start = time.time()
+        try:
+            self.result = self.function(*self.args)
+        except:
+            self.error = sys.exc_info()
+        self.finished = True
+        if self.primary:
+            self.hedger.primary.add(time.time() - start)
+        self.done.set()
+
+
+class Hedger:
+    """
+    Sends a second, identical request if the first one takes longer than the
+    given latency percentile, and keeps whichever answers first.
+
+    Both primary and effective latencies are recorded, so that the p99 with
+    and without hedging can be compared (see stats()).
+    """
+
+    def __init__(self, percentile=95, min_samples=20):
+        self.enabled = False
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.primary = LatencyStats()
+        self.effective = LatencyStats()
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def threshold(self):
+        if len(self.primary) < self.min_samples:
+            return None
+        return self.primary.percentile(self.percentile)
+
+    def run(self, function, *args):
+        start = time.time()
+        self.requests += 1
+        if not self.enabled:
+            try:
+                return function(*args)
+            finally:
+                self.primary.add(time.time() - start)
+                self.effective.add(time.time() - start)
+
+        done = threading.Event()
+        first = _Attempt(function, args, done, self, True)
+        first.start()
+        attempts = [first]
+
+        threshold = self.threshold()
+        if threshold is not None:
+            done.wait(threshold)
+            if not first.finished:
+                self.hedged += 1
+                second = _Attempt(function, args, done, self, False)
+                second.start()
+                attempts.append(second)
+
+        while True:
+            done.wait()
+            done.clear()
+            finished = [a for a in attempts if a.finished]
+            winners = [a for a in finished if a.error is None]
+            if winners or len(finished) == len(attempts):
+                break
+
+        self.effective.add(time.time() - start)
+        if winners:
+            if winners[0] is not first:
+                self.hedge_wins += 1
+            return winners[0].result
+        error = first.error
+        raise error[0], error[1], error[2]
+
+    def stats(self):
+        return {'requests': self.requests,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'threshold': self.threshold(),
+                'p99_primary': self.primary.percentile(99),
+                'p99_effective': self.effective.percentile(99)}
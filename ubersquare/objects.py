@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012 Hugo Osvaldo Barrera <hugo@osvaldobarrera.com.ar>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Typed objects for foursquare's venues, users, tips and checkin results.
+
+Objects wrap the data as returned by the API (the parsed dict, or its JSON
+text; see Entity.load), and only pull their fields out of it the first time
+one of them is read.  There's a single live object per id:
+getting the same venue twice returns the same object, updated with whatever
+data arrived last.
+"""
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import weakref
+
+
+class Entity(object):
+    """
+    Base for all objects.  Subclasses list their fields in __slots__, and
+    fill them all in _parse(raw).
+    """
+    __slots__ = ('id', '_source', '__weakref__')
+    _instances = None
+
+    def __init__(self, id, source):
+        self.id = id
+        self._source = source
+
+    def _key(cls, data):
+        return data['id']
+    _key = classmethod(_key)
+
+    def get(cls, data):
+        """
+        Returns the object for data (a dict, as returned by the API).
+        """
+        return cls._get(cls._key(data), data)
+    get = classmethod(get)
+
+    def load(cls, id, text):
+        """
+        Returns the object for id, out of its JSON text.  The text is kept as
+        is, and only parsed if fields are read.
+        """
+        return cls._get(id, text)
+    load = classmethod(load)
+
+    def _get(cls, id, source):
+        if cls._instances is None:
+            cls._instances = weakref.WeakValueDictionary()
+        instance = cls._instances.get(id)
+        if instance is None:
+            instance = cls(id, source)
+            cls._instances[id] = instance
+        else:
+            instance.update(source)
+        return instance
+    _get = classmethod(_get)
+
+    def raw(self):
+        """
+        Returns the data as returned by the API.
+        """
+        if isinstance(self._source, dict):
+            return self._source
+        return json.loads(self._source)
+
+    def update(self, source):
+        """
+        Merges newer data in.  Keys the new data doesn't have (ie: details
+        that search results don't include) are kept.
+        """
+        if source is self._source or source == self._source:
+            return
+        if not isinstance(source, dict):
+            source = json.loads(source)
+        merged = dict(self.raw())
+        merged.update(source)
+        self._source = merged
+        for name in self.__slots__:
+            try:
+                object.__delattr__(self, name)
+            except AttributeError:
+                pass
+
+    def __getattr__(self, name):
+        # Only called for fields that haven't been set yet
+        if name not in self.__slots__:
+            raise AttributeError(name)
+        self._parse(self.raw())
+        return object.__getattribute__(self, name)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.id)
+
+
+class Venue(Entity):
+    __slots__ = ('name', 'address', 'crossStreet', 'city', 'postalCode', 'lat', 'lng', 'distance',
+                 'categories', 'primaryCategory', 'icon', 'beenHere', 'checkinsCount', 'usersCount')
+
+    def _parse(self, raw):
+        self.name = raw['name']
+        location = raw.get('location', {})
+        self.address = location.get('address')
+        self.crossStreet = location.get('crossStreet')
+        self.city = location.get('city')
+        self.postalCode = location.get('postalCode')
+        self.lat = location.get('lat')
+        self.lng = location.get('lng')
+        self.distance = location.get('distance')
+
+        categories = raw.get('categories', [])
+        self.categories = tuple([category['name'] for category in categories])
+        self.primaryCategory = None
+        self.icon = None
+        if categories:
+            self.icon = categories[0]['icon']['prefix'] + "64" + categories[0]['icon']['name']
+        for category in categories:
+            if category.get('primary') in (True, "true"):
+                self.primaryCategory = category['name']
+
+        # It's an int in venue histories, and a dict in full venue details
+        beenHere = raw.get('beenHere')
+        if isinstance(beenHere, dict):
+            beenHere = beenHere.get('count')
+        self.beenHere = beenHere
+
+        stats = raw.get('stats', {})
+        self.checkinsCount = stats.get('checkinsCount')
+        self.usersCount = stats.get('usersCount')
+
+    def streetLine(self):
+        return ", ".join([part for part in (self.address, self.crossStreet) if part])
+
+    def cityLine(self):
+        return ", ".join([part for part in (self.postalCode, self.city) if part])
+
+
+class User(Entity):
+    __slots__ = ('firstName', 'lastName', 'name', 'photo', 'homeCity', 'relationship',
+                 'checkinsCount', 'badgesCount', 'mayorshipsCount')
+
+    def _parse(self, raw):
+        self.firstName = raw.get('firstName', "")
+        self.lastName = raw.get('lastName', "")
+        self.name = " ".join([part for part in (self.firstName, self.lastName) if part])
+        self.photo = raw.get('photo')
+        self.homeCity = raw.get('homeCity')
+        self.relationship = raw.get('relationship')
+        self.checkinsCount = raw.get('checkins', {}).get('count')
+        self.badgesCount = raw.get('badges', {}).get('count')
+        self.mayorshipsCount = raw.get('mayorships', {}).get('count')
+
+
+class Tip(Entity):
+    __slots__ = ('text', 'user', 'doneCount', 'todoCount', 'done', 'todo')
+
+    def _parse(self, raw):
+        self.text = raw['text']
+        self.user = None
+        if 'user' in raw and 'id' in raw['user']:
+            self.user = User.get(raw['user'])
+        self.doneCount = raw.get('done', {}).get('count', 0)
+        self.todoCount = raw.get('todo', {}).get('count', 0)
+
+        listed = [group['type'] for group in raw.get('listed', {}).get('groups', [])]
+        self.done = "dones" in listed
+        self.todo = "todos" in listed
+
+
+class CheckinResult(Entity):
+    """
+    What foursquare replied to a checkin: the checkin itself, and the
+    notifications (messages, points, mayorships and badges) that came along.
+    """
+    __slots__ = ('venue', 'messages', 'total', 'scores', 'mayorship', 'mayorshipType', 'badges')
+
+    def _key(cls, data):
+        return data['response']['checkin']['id']
+    _key = classmethod(_key)
+
+    def _parse(self, raw):
+        self.venue = None
+        if 'venue' in raw['response']['checkin']:
+            self.venue = Venue.get(raw['response']['checkin']['venue'])
+        self.messages = []
+        self.total = None
+        self.scores = []
+        self.mayorship = None
+        self.mayorshipType = None
+        self.badges = []
+        for item in raw.get('notifications', []):
+            if item['type'] == "message":
+                self.messages.append(item['item']['message'])
+            elif item['type'] == "score":
+                self.total = item['item']['total']
+                self.scores = [(score['points'], score['message']) for score in item['item']['scores']]
+            elif item['type'] == "mayorship":
+                self.mayorship = item['item']['message']
+                self.mayorshipType = item['item'].get('type')
+            elif item['type'] == "badge":
+                self.badges.append(item['item']['name'])
+
+
+if __name__ == "__main__":
+    # Memory per venue, for what the app actually holds: venue lists used to
+    # keep the parsed dicts, and now keep VenueRows (built through Venue.get);
+    # a Venue object itself keeps its dict, plus the fields read.  Measured
+    # as the growth of the process' resident memory (sys.getsizeof needs
+    # Python 2.6), so it's only meaningful on Linux (ie: the device).
+    import gc
+    # rows.py imports this module again, as objects
+    from objects import Venue
+    from rows import VenueRow
+
+    def rss():
+        gc.collect()
+        for line in open("/proc/self/status"):
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+
+    count = 5000
+    texts = []
+    for i in range(count):
+        texts.append(json.dumps({'id': "4b%022d" % i, 'name': "Venue number %d" % i,
+                                 'contact': {'phone': "5555555", 'formattedPhone': "555-5555"},
+                                 'location': {'address': "%d Some Street" % i, 'crossStreet': "at Another Street",
+                                              'lat': -34.6 + i * 0.0001, 'lng': -58.4, 'city': "Buenos Aires",
+                                              'state': "Buenos Aires", 'country': "Argentina", 'postalCode': "1414"},
+                                 'categories': [{'id': "4bf58dd8d48988d1c4941735", 'name': "Restaurant",
+                                                 'pluralName': "Restaurants", 'shortName': "Restaurant",
+                                                 'icon': {'prefix': "https://foursquare.com/img/categories/food/default_",
+                                                          'sizes': [32, 44, 64, 88, 256], 'name': ".png"},
+                                                 'primary': True}],
+                                 'verified': False, 'stats': {'checkinsCount': i, 'usersCount': i, 'tipCount': 0},
+                                 'beenHere': i % 7}))
+
+    start = rss()
+    rows = []
+    for text in texts:
+        rows.append(VenueRow(Venue.get(json.loads(text))))
+    rowSize = rss() - start
+
+    start = rss()
+    dicts = [json.loads(text) for text in texts]
+    dictSize = rss() - start
+
+    start = rss()
+    venues = [Venue.get(venue) for venue in dicts]
+    for venue in venues:
+        venue.name, venue.icon
+    venueSize = rss() - start
+
+    print "dicts: %d bytes per venue" % (dictSize / count)
+    print "VenueRows: %d bytes per venue" % (rowSize / count)
+    print "Venue objects: %d bytes per venue, on top of their dicts" % (venueSize / count)
+    assert Venue.get(dicts[0]) is venues[0]
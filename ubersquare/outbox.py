@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012 Hugo Osvaldo Barrera <hugo@osvaldobarrera.com.ar>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import sqlite3
+import threading
+import time
+
+
+class OutboxItem:
+    def __init__(self, row):
+        self.id, self.kind, self.path, params, self.key, self.state, self.created, extra = row
+        self.params = json.loads(params)
+        self.extra = None
+        if extra:
+            self.extra = json.loads(extra)
+
+
+class Outbox:
+    """
+    A durable queue of writes (checkins, tips, todo/done toggles) for
+    foursquare.
+
+    Items are sent strictly in order.  A queued toggle (an item with a key)
+    that is followed by the opposite toggle for the same key cancels out, and
+    neither is sent.
+
+    Handlers can be registered per kind of item, to be called once an item is
+    delivered or once foursquare has rejected it for good.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__flushing = threading.Lock()
+        self.__sending = None
+        self.__flusher = None
+        self.delivered = dict()
+        self.failed = dict()
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, path TEXT, params TEXT, key TEXT, state INTEGER, created REAL, extra TEXT)")
+        conn.commit()
+        conn.close()
+
+    def on_delivered(self, kind, handler):
+        """
+        handler(item, response) is called for every delivered item of this kind.
+        """
+        self.delivered[kind] = handler
+
+    def on_failed(self, kind, handler):
+        """
+        handler(item, response) is called for every rejected item of this kind.
+        """
+        self.failed[kind] = handler
+
+    def enqueue(self, kind, path, params, key=None, state=None, extra=None):
+        """
+        Queues a write.  Returns the new item's id, or None if it cancelled out
+        a previously queued toggle.
+        """
+        self.__lock.acquire()
+        conn = sqlite3.connect(self.path)
+        try:
+            if key is not None:
+                c = conn.cursor()
+                c.execute("SELECT id, state FROM outbox WHERE key = ? ORDER BY id DESC", (key,))
+                row = c.fetchone()
+                if row and row[0] != self.__sending:
+                    conn.execute("DELETE FROM outbox WHERE id = ?", (row[0],))
+                    if row[1] != state:
+                        conn.commit()
+                        return None
+            if extra is not None:
+                extra = json.dumps(extra)
+            c = conn.cursor()
+            c.execute("INSERT INTO outbox (kind, path, params, key, state, created, extra) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      (kind, path, json.dumps(params), key, state, time.time(), extra))
+            conn.commit()
+            return c.lastrowid
+        finally:
+            conn.close()
+            self.__lock.release()
+
+    def items(self):
+        conn = sqlite3.connect(self.path)
+        c = conn.cursor()
+        c.execute("SELECT id, kind, path, params, key, state, created, extra FROM outbox ORDER BY id")
+        items = [OutboxItem(row) for row in c.fetchall()]
+        conn.close()
+        return items
+
+    def depth(self):
+        conn = sqlite3.connect(self.path)
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM outbox")
+        depth = c.fetchone()[0]
+        conn.close()
+        return depth
+
+    def __exists(self, item):
+        conn = sqlite3.connect(self.path)
+        c = conn.cursor()
+        c.execute("SELECT id FROM outbox WHERE id = ?", (item.id,))
+        exists = c.fetchone() is not None
+        conn.close()
+        return exists
+
+    def __remove(self, item):
+        conn = sqlite3.connect(self.path)
+        conn.execute("DELETE FROM outbox WHERE id = ?", (item.id,))
+        conn.commit()
+        conn.close()
+
+    def flush(self, post):
+        """
+        Sends queued items, in order, using post(path, params), until the queue
+        is empty or a network error occurs.  Returns a dict mapping the ids of
+        sent items (whether delivered or rejected) to their responses.
+        """
+        responses = dict()
+        self.__flushing.acquire()
+        try:
+            for item in self.items():
+                self.__lock.acquire()
+                try:
+                    # It may have been cancelled out since we listed the queue.
+                    if not self.__exists(item):
+                        continue
+                    self.__sending = item.id
+                finally:
+                    self.__lock.release()
+                try:
+                    try:
+                        response = post(item.path, item.params)
+                    except (IOError, ValueError), e:
+                        print "Couldn't send queued %s (%s)" % (item.kind, e)
+                        break
+                finally:
+                    self.__lock.acquire()
+                    self.__sending = None
+                    self.__lock.release()
+
+                self.__remove(item)
+                responses[item.id] = response
+                code = response.get('meta', {}).get('code', 200)
+                if code >= 400:
+                    print "foursquare rejected queued %s (%s)" % (item.kind, code)
+                    handler = self.failed.get(item.kind)
+                else:
+                    handler = self.delivered.get(item.kind)
+                if handler:
+                    # The item is gone already, so whatever goes wrong
+                    # updating things locally mustn't lose the response
+                    try:
+                        handler(item, response)
+                    except Exception, e:
+                        print "Couldn't handle sent %s (%s)" % (item.kind, e)
+        finally:
+            self.__flushing.release()
+        return responses
+
+    def start_flusher(self, post, interval=30, max_interval=600):
+        """
+        Starts a background thread that keeps flushing the queue (backing off
+        while there's no connectivity) until it's empty.
+        """
+        self.__lock.acquire()
+        try:
+            if self.__flusher is not None:
+                return
+            self.__flusher = threading.Thread(target=self.__flush_loop, args=(post, interval, max_interval))
+            self.__flusher.setDaemon(True)
+            self.__flusher.start()
+        finally:
+            self.__lock.release()
+
+    def __flush_loop(self, post, interval, max_interval):
+        try:
+            while True:
+                self.flush(post)
+                self.__lock.acquire()
+                try:
+                    if self.depth() == 0:
+                        self.__flusher = None
+                        return
+                finally:
+                    self.__lock.release()
+                time.sleep(interval)
+                interval = min(interval * 2, max_interval)
+        finally:
+            # If this thread died, let start_flusher start another one
+            self.__lock.acquire()
+            if self.__flusher is threading.currentThread():
+                self.__flusher = None
+            self.__lock.release()
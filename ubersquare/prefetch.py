@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012 Hugo Osvaldo Barrera <hugo@osvaldobarrera.com.ar>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import threading
+
+from scheduler import Priority, set_priority
+
+
+class Prefetcher:
+    """
+    Fetches, in the background, things the user is likely to open next (ie:
+    the details of the venues on screen), within a budget of requests and
+    bytes per session.
+
+    fetch(key) must fetch key into the cache, and return the number of bytes
+    it downloaded (0 if it was cached already, None if it failed).
+    """
+
+    def __init__(self, fetch, max_requests=50, max_bytes=1024 * 1024, priority=Priority.Prefetch):
+        self.fetch = fetch
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.priority = priority
+        self.requests = 0
+        self.bytes = 0
+        self.__condition = threading.Condition()
+        self.__wanted = []
+        self.__done = set()
+        self.__worker = None
+
+    def exhausted(self):
+        return self.requests >= self.max_requests or self.bytes >= self.max_bytes
+
+    def want(self, keys):
+        """
+        Replaces whatever was waiting to be fetched with keys (in order).
+        Only what's on screen right now is worth fetching.
+        """
+        self.__condition.acquire()
+        try:
+            if self.exhausted():
+                return
+            self.__wanted = [key for key in keys if key not in self.__done]
+            if self.__worker is None:
+                self.__worker = threading.Thread(target=self.__run)
+                self.__worker.setDaemon(True)
+                self.__worker.start()
+            self.__condition.notify()
+        finally:
+            self.__condition.release()
+
+    def stats(self):
+        return {'requests': self.requests, 'bytes': self.bytes,
+                'max_requests': self.max_requests, 'max_bytes': self.max_bytes}
+
+    def __run(self):
+        set_priority(self.priority)
+        while True:
+            self.__condition.acquire()
+            try:
+                while not self.__wanted:
+                    self.__condition.wait()
+                key = self.__wanted.pop(0)
+                self.__done.add(key)
+            finally:
+                self.__condition.release()
+
+            # Anything that escaped would kill the worker for the session
+            # (ie: a bad response body, or the cache being locked)
+            try:
+                size = self.fetch(key)
+            except Exception, e:
+                print "Couldn't prefetch %s (%s)" % (key, e)
+                size = None
+
+            # Failed fetches count as requests too, so that a dead network
+            # can't keep the prefetcher trying forever
+            if size is None or size:
+                self.requests += 1
+            if size:
+                self.bytes += size
+            if self.exhausted():
+                print "Prefetching budget used up (%d requests, %d bytes)" % (self.requests, self.bytes)
+                self.__condition.acquire()
+                self.__wanted = []
+                self.__condition.release()
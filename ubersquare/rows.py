@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012 Hugo Osvaldo Barrera <hugo@osvaldobarrera.com.ar>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Precomputed rows for the list models (see custom_widgets.RowListModel).
+
+Models used to navigate the raw venue dicts on every data() call (ie: for
+every role, for every visible row, on every repaint).  Rows are now built
+once, when the list is set, and data() just reads a field.
+"""
+
+from geo import distances
+from objects import Venue, User, Tip
+
+NO_CATEGORY_ICON = "https://foursquare.com/img/categories/none_64.png"
+
+
+def category_icon(category, size="64"):
+    return category['icon']['prefix'] + size + category['icon']['name']
+
+
+class VenueRow(object):
+    """
+    What a venue list shows for a venue.  Rows don't keep the venue itself;
+    it's looked up by id when it's opened (see foursquare.stored_venue).
+    distance is the one the API returned (see venue_distances for others).
+    """
+    __slots__ = ('id', 'display', 'label', 'icon', 'name', 'terms', 'lat', 'lng', 'distance')
+
+    def __init__(self, venue):
+        self.id = venue.id
+
+        name = venue.name
+        if len(name) > 72:
+            name = name[0:70]
+        self.name = name.lower()
+
+        address = "(no address)"
+        if venue.address:
+            address = venue.address
+            if len(address) > 72:
+                address = address[0:70]
+
+        self.lat = venue.lat
+        self.lng = venue.lng
+        self.label = name + "\n  " + address
+        self.distance = venue.distance
+        self.display = self.label_with(venue.distance)
+
+        self.icon = venue.icon or NO_CATEGORY_ICON
+
+        # What type-to-filter searches
+        terms = [venue.name, venue.address or "", venue.city or ""]
+        terms.extend(venue.categories)
+        self.terms = u" ".join(terms)
+
+    def label_with(self, distance):
+        if distance is None:
+            return self.label
+        return self.label + " (" + str(distance) + " metres away)"
+
+    def record(self):
+        """
+        Returns a minimal venue, as returned by the API, for when the venue
+        itself isn't stored anymore.
+        """
+        venue = {'id': self.id, 'name': self.label.split("\n")[0], 'location': {}}
+        if self.lat is not None:
+            venue['location'] = {'lat': self.lat, 'lng': self.lng}
+        return venue
+
+    def looks_like(self, other):
+        return self.display == other.display and self.icon == other.icon
+
+
+def venue_rows(venues):
+    """
+    Builds the rows for a venue array (see foursquare.build_venue_array).
+    """
+    if not venues:
+        return []
+    return [VenueRow(Venue.get(venues[i]['venue'])) for i in range(len(venues))]
+
+
+def venue_distances(rows, origin):
+    """
+    Returns the distances from origin (a (lat, lng) tuple) to the venues in
+    rows that have a location, by id, all calculated in one batch.
+    """
+    located = [row for row in rows if row.lat is not None]
+    return dict(zip([row.id for row in located],
+                    distances(origin[0], origin[1], [row.lat for row in located], [row.lng for row in located])))
+
+
+# Item data roles (the first two are Qt's, which rows.py doesn't import)
+DisplayRole = 0
+DecorationRole = 1
+VenueRole = 849561745
+DistanceRole = 849561746
+
+
+def venue_data(model, index, role=DisplayRole):
+    """
+    VenueListModel.data(); it only reads precomputed rows and distances, and
+    needs nothing from Qt (other than index.row()), so it can be benchmarked
+    without it.  model.distances are the venue_distances from the current
+    origin (None if there's none), and model.rowIcon(url) must return the
+    icon for a url.
+    """
+    row = model.rows[index.row()]
+    if role == DisplayRole:
+        if model.distances is not None and row.id in model.distances:
+            return row.label_with(model.distances[row.id])
+        return row.display
+    elif role == DecorationRole:
+        return model.rowIcon(row.icon)
+    elif role == VenueRole:
+        return row.id
+    elif role == DistanceRole:
+        distance = None
+        if model.distances is not None:
+            distance = model.distances.get(row.id)
+        if distance is None:
+            distance = row.distance
+        # Venues without a known distance go last
+        if distance is None:
+            return 1e12
+        return distance
+
+
+class UserRow(object):
+    __slots__ = ('id', 'display', 'icon', 'terms', 'user')
+
+    def __init__(self, item):
+        user = User.get(item['user'])
+        self.id = user.id
+        self.user = item
+
+        text = user.name
+        self.terms = text
+        score = item['scores']
+        text += "\n  " + str(score['recent']) + "/" + str(score['max']) + " (" + str(score['checkinsCount']) + " checkins" + ")"
+        self.display = text
+        self.icon = user.photo
+
+    def looks_like(self, other):
+        return self.display == other.display and self.icon == other.icon
+
+
+def user_rows(users):
+    if not users:
+        return []
+    return [UserRow(users[i]) for i in range(len(users))]
+
+
+class TipRow(object):
+    __slots__ = ('id', 'text', 'terms', 'done', 'todo', 'doneCount', 'todoCount')
+
+    def __init__(self, tip):
+        self.id = tip.id
+        self.text = tip.text
+        self.terms = tip.text
+        self.done = tip.done
+        self.todo = tip.todo
+        self.doneCount = tip.doneCount
+        self.todoCount = tip.todoCount
+
+    def looks_like(self, other):
+        return self.text == other.text and \
+            (self.done, self.todo, self.doneCount, self.todoCount) == \
+            (other.done, other.todo, other.doneCount, other.todoCount)
+
+
+def tip_rows(groups):
+    """
+    Builds the rows for all the tips in a venue's tip groups.
+    """
+    return [TipRow(Tip.get(tip)) for group in groups for tip in group['items']]
+
+
+def diff_rows(old, new):
+    """
+    Returns the list of operations that turn the rows in old into the ones in
+    new (rows are matched by id), in the order they must be applied:
+     - ('remove', first, last)
+     - ('insert', first, rows)
+     - ('move', source, destination)
+     - ('change', row, newRow)
+    Returns None if rows can't be matched (ie: there are duplicate ids).
+    """
+    newIds = set([row.id for row in new])
+    if len(newIds) != len(new) or len(set([row.id for row in old])) != len(old):
+        return None
+
+    operations = []
+    current = list(old)
+
+    # Removals, bottom-up, in contiguous blocks
+    last = len(current) - 1
+    while last >= 0:
+        if current[last].id in newIds:
+            last -= 1
+            continue
+        first = last
+        while first > 0 and current[first - 1].id not in newIds:
+            first -= 1
+        operations.append(('remove', first, last))
+        del current[first:last + 1]
+        last = first - 1
+
+    # Inserts, moves and changes, top-down
+    present = set([row.id for row in current])
+    i = 0
+    while i < len(new):
+        row = new[i]
+        if i < len(current) and current[i].id == row.id:
+            if not current[i].looks_like(row):
+                operations.append(('change', i, row))
+            current[i] = row
+            i += 1
+        elif row.id not in present:
+            run = i
+            while run < len(new) and new[run].id not in present:
+                run += 1
+            operations.append(('insert', i, new[i:run]))
+            current[i:i] = new[i:run]
+            i = run
+        else:
+            source = i + 1
+            while current[source].id != row.id:
+                source += 1
+            operations.append(('move', source, i))
+            current.insert(i, current.pop(source))
+            if not current[i].looks_like(row):
+                operations.append(('change', i, row))
+            current[i] = row
+            i += 1
+
+    return operations
+
+
+if __name__ == "__main__":
+    # Benchmark of VenueListModel.data() on a 5,000-row model, against the
+    # model as it was before rows (navigating the venue dicts on every call).
+    # Both get the same data(index, role) calls.  Qt isn't needed: models,
+    # indexes and icons are stand-ins, and icons are "loaded" the same way
+    # for both (the old model loaded one on every call, the new one caches).
+    import time
+
+    def QIcon(path):
+        return path
+
+    def image(path):
+        return path
+
+    icons = dict()
+
+    def icon(url):
+        if url not in icons:
+            icons[url] = QIcon(image(url))
+        return icons[url]
+
+    def legacy_data(self, index, role=DisplayRole):
+        venue = self.venues[index.row()]['venue']
+        if role == DisplayRole:
+            name = venue['name']
+            if len(name) > 72:
+                name = name[0:70]
+            address = "(no address)"
+            if 'address' in venue['location']:
+                address = venue['location']['address']
+                if len(address) > 72:
+                    address = address[0:70]
+            distance = ""
+            if 'distance' in venue['location']:
+                distance = " (" + str(venue['location']['distance']) + " metres away)"
+            return name + "\n  " + address + distance
+        elif role == DecorationRole:
+            if len(venue['categories']) > 0:
+                prefix = venue['categories'][0]['icon']['prefix']
+                extension = venue['categories'][0]['icon']['name']
+                image_url = prefix + "64" + extension
+            else:
+                image_url = NO_CATEGORY_ICON
+            return QIcon(image(image_url))
+        elif role == VenueRole:
+            return venue
+
+    class Index(object):
+        __slots__ = ('number',)
+
+        def __init__(self, number):
+            self.number = number
+
+        def row(self):
+            return self.number
+
+    class Model(object):
+        def __init__(self, data, count, **fields):
+            self.data = data
+            self.count = count
+            self.__dict__.update(fields)
+
+        def rowIcon(self, url):
+            return icon(url)
+
+    venues = dict()
+    for i in range(5000):
+        venues[i] = {'venue': {'id': "v%d" % i, 'name': "Venue number %d" % i,
+                               'location': {'address': "%d Some Street" % i, 'distance': i,
+                                            'lat': -34.6 + i * 1e-5, 'lng': -58.4},
+                               'categories': [{'name': "Food", 'icon': {'prefix': "https://foursquare.com/img/categories/food/default_", 'name': ".png"}}]}}
+
+    start = time.time()
+    rows = venue_rows(venues)
+    print "Built %d rows in %.3fs" % (len(rows), time.time() - start)
+
+    start = time.time()
+    venue_distances(rows, (-34.6, -58.4))
+    print "Calculated %d distances in %.3fs" % (len(rows), time.time() - start)
+
+    models = (("VenueListModel", Model(venue_data, len(rows), rows=rows, distances=None)),
+              ("Legacy model", Model(legacy_data, len(venues), venues=venues)))
+    roles = (DisplayRole, DecorationRole, VenueRole)
+    for name, model in models:
+        indexes = [Index(i) for i in range(model.count)]
+        data = model.data
+        calls = 0
+        start = time.time()
+        for n in range(5):
+            for index in indexes:
+                for role in roles:
+                    data(model, index, role)
+                    calls += 1
+        print "%s: %d data() calls per second" % (name, calls / (time.time() - start))
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012 Hugo Osvaldo Barrera <hugo@osvaldobarrera.com.ar>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import threading
+import heapq
+import time
+
+
+class Priority:
+    """
+    Request classes, from most to least urgent.
+    """
+    Interactive = 0
+    Prefetch = 1
+    Background = 2
+
+    names = {Interactive: "interactive", Prefetch: "prefetch", Background: "background"}
+
+
+# Thread-local "current" priority. Worker threads set this once in their run()
+# so that every request they make (even deep inside foursquare.py) is tagged.
+_current = threading.local()
+
+
+def set_priority(priority):
+    _current.priority = priority
+
+
+def current_priority():
+    return getattr(_current, 'priority', Priority.Interactive)
+
+
+class _Ticket(object):
+    __slots__ = ('priority', 'seq', 'queued_at')
+
+    def __init__(self, priority, seq):
+        self.priority = priority
+        self.seq = seq
+        self.queued_at = time.time()
+
+    def __cmp__(self, other):
+        return cmp((self.priority, self.seq), (other.priority, other.seq))
+
+
+class RequestScheduler:
+    """
+    Gates every network request made by the application.
+
+    Requests are run by the calling thread, but only once they've been granted
+    a slot.  Waiting requests are served strictly by priority (and FIFO within
+    the same priority), so an interactive request that arrives while dozens of
+    icon downloads are queued jumps straight ahead of them.  Each class has its
+    own concurrency limit, and lower classes may never use the slots reserved
+    for interactive requests.
+    """
+
+    def __init__(self, limits=None, total=4):
+        if limits is None:
+            limits = {Priority.Interactive: 4, Priority.Prefetch: 2, Priority.Background: 1}
+        self.limits = limits
+        self.total = total
+        self.__lock = threading.Condition()
+        self.__queue = []
+        self.__seq = 0
+        self.__running = dict([(p, 0) for p in limits])
+        self.__stats = dict([(p, {'requests': 0, 'wait': 0.0, 'max_wait': 0.0, 'bytes': 0}) for p in limits])
+
+    def __has_room(self, priority):
+        if self.__running[priority] >= self.limits[priority]:
+            return False
+        busy = sum(self.__running.values())
+        if priority != Priority.Interactive:
+            # Keep one slot free for interactive requests at all times.
+            return busy < self.total - 1
+        return busy < self.total
+
+    def __can_run(self, ticket):
+        if not self.__has_room(ticket.priority):
+            return False
+        # Only overtake more urgent (or older) requests that are blocked anyway.
+        for other in self.__queue:
+            if other < ticket and self.__has_room(other.priority):
+                return False
+        return True
+
+    def acquire(self, priority):
+        self.__lock.acquire()
+        try:
+            self.__seq += 1
+            ticket = _Ticket(priority, self.__seq)
+            heapq.heappush(self.__queue, ticket)
+            while not self.__can_run(ticket):
+                self.__lock.wait()
+            self.__queue.remove(ticket)
+            heapq.heapify(self.__queue)
+            self.__running[priority] += 1
+
+            wait = time.time() - ticket.queued_at
+            stats = self.__stats[priority]
+            stats['requests'] += 1
+            stats['wait'] += wait
+            stats['max_wait'] = max(stats['max_wait'], wait)
+        finally:
+            self.__lock.release()
+
+    def release(self, priority, size=0):
+        self.__lock.acquire()
+        try:
+            self.__running[priority] -= 1
+            self.__stats[priority]['bytes'] += size
+            self.__lock.notifyAll()
+        finally:
+            self.__lock.release()
+
+    def run(self, priority, function, *args):
+        """
+        Runs function(*args) once a slot for the given priority is available.
+        """
+        if priority is None:
+            priority = current_priority()
+        self.acquire(priority)
+        size = 0
+        try:
+            result = function(*args)
+            if isinstance(result, basestring):
+                size = len(result)
+            return result
+        finally:
+            self.release(priority, size)
+
+    def queued(self, priority=None):
+        self.__lock.acquire()
+        try:
+            if priority is None:
+                return len(self.__queue)
+            return len([t for t in self.__queue if t.priority == priority])
+        finally:
+            self.__lock.release()
+
+    def stats(self):
+        """
+        Returns per-class queue-wait metrics, keyed by class name.
+        """
+        self.__lock.acquire()
+        try:
+            result = dict()
+            for priority, stats in self.__stats.items():
+                average = 0.0
+                if stats['requests']:
+                    average = stats['wait'] / stats['requests']
+                result[Priority.names[priority]] = {
+                    'requests': stats['requests'],
+                    'queued': len([t for t in self.__queue if t.priority == priority]),
+                    'running': self.__running[priority],
+                    'avg_wait': average,
+                    'max_wait': stats['max_wait'],
+                    'bytes': stats['bytes']}
+            return result
+        finally:
+            self.__lock.release()
+
+
+class RateBudget:
+    """
+    Keeps track of the API quota, as reported by foursquare on every response.
+
+    When the remaining quota runs low, background traffic is dropped first,
+    then prefetching; interactive requests are only refused once the quota is
+    exhausted.  Requests that aren't allowed should be answered from the cache.
+    """
+
+    # Fraction of the quota that must remain for each class to hit the network.
+    reserve = {Priority.Interactive: 0.0, Priority.Prefetch: 0.15, Priority.Background: 0.3}
+    # Below this fraction, non-interactive requests are spaced out.
+    slowdown = 0.5
+    slowdown_interval = 2.0
+    # foursquare quotas are hourly; if we hear nothing for this long, assume
+    # the quota has been reset.
+    window = 3600
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        self.__last_request = 0.0
+        self.dropped = dict([(p, 0) for p in Priority.names])
+
+    def update(self, headers):
+        """
+        Reads the quota from a response's headers (a mimetools.Message).
+        """
+        limit = headers.getheader("X-RateLimit-Limit")
+        remaining = headers.getheader("X-RateLimit-Remaining")
+        reset = headers.getheader("X-RateLimit-Reset")
+        self.__lock.acquire()
+        try:
+            if limit is not None and remaining is not None:
+                self.limit = int(limit)
+                self.remaining = int(remaining)
+                if reset is not None:
+                    self.reset_at = float(reset)
+                else:
+                    self.reset_at = time.time() + self.window
+        finally:
+            self.__lock.release()
+
+    def exhausted(self):
+        self.__lock.acquire()
+        try:
+            self.remaining = 0
+            if not self.limit:
+                self.limit = 1
+            self.reset_at = time.time() + self.window
+        finally:
+            self.__lock.release()
+
+    def fraction(self):
+        """
+        Returns the fraction of the quota still available (1.0 if unknown).
+        """
+        self.__lock.acquire()
+        try:
+            if self.limit is None or self.reset_at is None or time.time() > self.reset_at:
+                return 1.0
+            if self.limit == 0:
+                return 0.0
+            return float(self.remaining) / self.limit
+        finally:
+            self.__lock.release()
+
+    def allows(self, priority):
+        fraction = self.fraction()
+        if priority == Priority.Interactive:
+            allowed = fraction > 0.0
+        else:
+            allowed = fraction > self.reserve[priority]
+        if not allowed:
+            self.dropped[priority] += 1
+        return allowed
+
+    def throttle(self, priority):
+        """
+        Sleeps as needed to space out non-interactive requests when the quota
+        is running low.
+        """
+        if priority == Priority.Interactive or self.fraction() > self.slowdown:
+            return
+        self.__lock.acquire()
+        try:
+            wait = self.__last_request + self.slowdown_interval - time.time()
+            self.__last_request = max(time.time(), self.__last_request + self.slowdown_interval)
+        finally:
+            self.__lock.release()
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012 Hugo Osvaldo Barrera <hugo@osvaldobarrera.com.ar>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import sqlite3
+import time
+
+from textindex import tokens
+from geo import parse_ll, distance, distances, geohash, geohash_cover, bounding_box
+
+# Stale search results are kept this long, in seconds, for use offline
+SEARCH_CACHE_KEEP = 30 * 24 * 60 * 60
+
+
+class LocalStore:
+    """
+    Structured, local copies of foursquare data, kept in the cache database.
+
+    Unlike the "queries" table (which caches whole responses by URL), data
+    here is kept per venue, so that it can be updated incrementally.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE IF NOT EXISTS sync (name TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS history (venue_id TEXT PRIMARY KEY, position INTEGER, beenHere INTEGER, lastHere INTEGER, generation INTEGER, venue TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS venues (id TEXT PRIMARY KEY, venue TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS venue_search (rowid INTEGER PRIMARY KEY, id TEXT UNIQUE, name TEXT, text TEXT, categories TEXT, lat REAL, lng REAL)")
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE name = 'venue_fts'")
+        self.fts = c.fetchone() is not None
+        if not self.fts:
+            try:
+                conn.execute("CREATE VIRTUAL TABLE venue_fts USING fts3(text)")
+                self.fts = True
+            except sqlite3.OperationalError:
+                # No FTS3 in this sqlite; searches use LIKE instead
+                print "sqlite has no FTS3 support; local searches will be slower"
+        c.execute("PRAGMA table_info(venue_search)")
+        if 'geohash' not in [row[1] for row in c.fetchall()]:
+            conn.execute("ALTER TABLE venue_search ADD COLUMN geohash TEXT")
+            c.execute("SELECT rowid, lat, lng FROM venue_search WHERE lat IS NOT NULL")
+            for rowid, lat, lng in c.fetchall():
+                conn.execute("UPDATE venue_search SET geohash = ? WHERE rowid = ?", (geohash(lat, lng), rowid))
+        conn.execute("CREATE INDEX IF NOT EXISTS venue_search_geohash ON venue_search (geohash)")
+        conn.execute("CREATE TABLE IF NOT EXISTS search_cache (tile TEXT, category TEXT, query TEXT, complete INTEGER, created INTEGER, ids TEXT, PRIMARY KEY (tile, category, query))")
+        c.execute("SELECT COUNT(*) FROM venue_search")
+        if c.fetchone()[0] == 0:
+            c.execute("SELECT venue FROM venues UNION ALL SELECT venue FROM history")
+            for row in c.fetchall():
+                self.__index(conn, json.loads(row[0]))
+        conn.commit()
+        conn.close()
+
+    def __connect(self):
+        return sqlite3.connect(self.path)
+
+    ########
+    # SYNC #
+    ########
+
+    def sync_get(self, name):
+        conn = self.__connect()
+        c = conn.cursor()
+        c.execute("SELECT value FROM sync WHERE name = ?", (name,))
+        row = c.fetchone()
+        conn.close()
+        if row:
+            return row[0]
+
+    def sync_set(self, name, value):
+        conn = self.__connect()
+        conn.execute("INSERT OR REPLACE INTO sync VALUES (?, ?)", (name, value))
+        conn.commit()
+        conn.close()
+
+    def sync_del(self, name):
+        conn = self.__connect()
+        conn.execute("DELETE FROM sync WHERE name = ?", (name,))
+        conn.commit()
+        conn.close()
+
+    ##########
+    # VENUES #
+    ##########
+
+    def venues_put(self, venues):
+        """
+        Stores (or updates) venues, as returned by the API.
+        """
+        conn = self.__connect()
+        for venue in venues:
+            conn.execute("INSERT OR REPLACE INTO venues VALUES (?, ?)", (venue['id'], json.dumps(venue)))
+            self.__index(conn, venue)
+        conn.commit()
+        conn.close()
+
+    def venue(self, venueId):
+        """
+        Returns a stored venue (with beenHere, if it's in the history), or None.
+        """
+        conn = self.__connect()
+        c = conn.cursor()
+        c.execute("SELECT venue FROM venues WHERE id = ?", (venueId,))
+        row = c.fetchone()
+        c.execute("SELECT venue, beenHere FROM history WHERE venue_id = ?", (venueId,))
+        history = c.fetchone()
+        conn.close()
+
+        venue = None
+        if row:
+            venue = json.loads(row[0])
+        if history:
+            if venue is None:
+                venue = json.loads(history[0])
+            venue['beenHere'] = history[1]
+        return venue
+
+    def venues(self, venueIds):
+        venues = []
+        for venueId in venueIds:
+            venue = self.venue(venueId)
+            if venue:
+                venues.append(venue)
+        return venues
+
+    ##########
+    # SEARCH #
+    ##########
+
+    def __index(self, conn, venue):
+        location = venue.get('location', {})
+        categories = venue.get('categories', [])
+        words = [venue.get('name', ""), location.get('address', ""), location.get('city', "")]
+        words.extend([category['name'] for category in categories])
+        text = u" ".join([token for word in words for token in tokens(word)])
+        name = u" ".join(tokens(venue.get('name', "")))
+        categoryIds = " ".join([category['id'] for category in categories if 'id' in category])
+        lat = location.get('lat')
+        lng = location.get('lng')
+        cell = None
+        if lat is not None and lng is not None:
+            cell = geohash(lat, lng)
+
+        c = conn.cursor()
+        c.execute("SELECT rowid FROM venue_search WHERE id = ?", (venue['id'],))
+        row = c.fetchone()
+        if row:
+            conn.execute("UPDATE venue_search SET name = ?, text = ?, categories = ?, lat = ?, lng = ?, geohash = ? WHERE rowid = ?",
+                         (name, text, categoryIds, lat, lng, cell, row[0]))
+            if self.fts:
+                conn.execute("UPDATE venue_fts SET text = ? WHERE docid = ?", (text, row[0]))
+        else:
+            c.execute("INSERT INTO venue_search (id, name, text, categories, lat, lng, geohash) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      (venue['id'], name, text, categoryIds, lat, lng, cell))
+            if self.fts:
+                conn.execute("INSERT INTO venue_fts (docid, text) VALUES (?, ?)", (c.lastrowid, text))
+
+    def search(self, query, ll=None, categoryId=None, limit=25):
+        """
+        Returns the stored venues that have every word of query (as the start
+        of a word in their name, address, city or categories), nearest to ll
+        first.  Venues that match by name are ranked as if they were closer.
+        """
+        words = tokens(query)
+        if not words:
+            origin = parse_ll(ll)
+            if origin is None:
+                return []
+            return self.venues([venueId for metres, venueId in self.nearest(origin[0], origin[1], limit, categoryId)])
+        conn = self.__connect()
+        c = conn.cursor()
+        if self.fts:
+            match = " ".join([word + "*" for word in words])
+            c.execute("SELECT s.id, s.name, s.categories, s.lat, s.lng FROM venue_fts f, venue_search s WHERE f.text MATCH ? AND s.rowid = f.docid", (match,))
+        else:
+            where = " AND ".join(["(' ' || text) LIKE ?"] * len(words))
+            c.execute("SELECT id, name, categories, lat, lng FROM venue_search WHERE " + where, ["% " + word + "%" for word in words])
+        rows = c.fetchall()
+        conn.close()
+
+        origin = parse_ll(ll)
+        ranked = []
+        for venueId, name, categories, lat, lng in rows:
+            if categoryId and categoryId not in categories.split():
+                continue
+            if origin is None or lat is None:
+                metres = float(1 << 30)
+            else:
+                metres = distance(origin[0], origin[1], lat, lng)
+            nameWords = name.split()
+            if all([[n for n in nameWords if n.startswith(word)] for word in words]):
+                metres /= 4.0
+            ranked.append((metres, venueId))
+        ranked.sort()
+        return self.venues([venueId for metres, venueId in ranked[:limit]])
+
+    def within(self, south, west, north, east, categoryId=None):
+        """
+        Returns (id, lat, lng) for every stored venue within a bounding box.
+        """
+        conditions = []
+        params = []
+        for prefix in geohash_cover(south, west, north, east):
+            conditions.append("(geohash >= ? AND geohash < ?)")
+            params.extend([prefix, prefix + "~"])
+        conn = self.__connect()
+        c = conn.cursor()
+        c.execute("SELECT id, lat, lng, categories FROM venue_search WHERE " + " OR ".join(conditions), params)
+        rows = c.fetchall()
+        conn.close()
+        return [(venueId, lat, lng) for venueId, lat, lng, categories in rows
+                if south <= lat <= north and west <= lng <= east and
+                (not categoryId or categoryId in categories.split())]
+
+    def nearest(self, lat, lng, count, categoryId=None, max_distance=50000):
+        """
+        Returns (distance, id) for the count stored venues nearest to a point
+        (up to max_distance metres away), nearest first.
+        """
+        radius = 250
+        while True:
+            found = self.within(*(bounding_box(lat, lng, radius) + (categoryId,)))
+            metres = distances(lat, lng, [row[1] for row in found], [row[2] for row in found])
+            # Only venues within the radius are sure to be the nearest ones;
+            # the corners of the box may leave out nearer ones.
+            near = [(m, row[0]) for m, row in zip(metres, found) if m <= radius]
+            if len(near) >= count or radius >= max_distance:
+                near.sort()
+                return near[:count]
+            radius = min(radius * 4, max_distance)
+
+    ################
+    # SEARCH CACHE #
+    ################
+
+    def search_cache_put(self, tile, category, query, venues, complete):
+        """
+        Caches the results of a remote search within a tile.  complete means
+        that foursquare returned fewer venues than it was asked for (ie: those
+        are all the venues in the area that match).
+        """
+        conn = self.__connect()
+        conn.execute("DELETE FROM search_cache WHERE created < ?", (int(time.time()) - SEARCH_CACHE_KEEP,))
+        conn.execute("INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?, ?, ?, ?)",
+                     (tile, category, u" ".join(tokens(query)), int(complete), int(time.time()),
+                      json.dumps([venue['id'] for venue in venues])))
+        conn.commit()
+        conn.close()
+
+    def search_cache_get(self, tile, category, query, max_age=None):
+        """
+        Returns (venues, exact) for a search within a tile, or None.  When
+        the same search isn't cached, the complete results for a prefix of
+        the query (ie: "piz" for "pizza") are filtered locally instead.
+        Results older than max_age seconds are ignored, unless it's None.
+        """
+        query = u" ".join(tokens(query))
+        created = 0
+        if max_age is not None:
+            created = int(time.time()) - max_age
+        conn = self.__connect()
+        c = conn.cursor()
+        c.execute("SELECT query, complete, ids FROM search_cache WHERE tile = ? AND category = ? AND created >= ?", (tile, category, created))
+        rows = c.fetchall()
+        conn.close()
+
+        best = None
+        for cachedQuery, complete, ids in rows:
+            if cachedQuery == query:
+                best = (cachedQuery, ids)
+                break
+            if complete and query.startswith(cachedQuery) and (best is None or len(cachedQuery) > len(best[0])):
+                best = (cachedQuery, ids)
+        if best is None:
+            return None
+
+        venues = self.venues(json.loads(best[1]))
+        if best[0] == query:
+            return venues, True
+        words = query.split()
+        matching = []
+        for venue in venues:
+            terms = [venue.get('name', ""), venue.get('location', {}).get('address', "")]
+            terms.extend([category['name'] for category in venue.get('categories', [])])
+            venueWords = [token for term in terms for token in tokens(term)]
+            if all([[w for w in venueWords if w.startswith(word)] for word in words]):
+                matching.append(venue)
+        return matching, False
+
+    ###########
+    # HISTORY #
+    ###########
+
+    def history_count(self):
+        conn = self.__connect()
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM history")
+        count = c.fetchone()[0]
+        conn.close()
+        return count
+
+    def history_replace(self, items, generation, offset):
+        """
+        Stores a page of a full venuehistory download.  Items from an older
+        generation are removed by history_prune once all pages are in.
+        """
+        conn = self.__connect()
+        position = offset
+        for item in items:
+            conn.execute("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?, ?)",
+                         (item['venue']['id'], position, item.get('beenHere', 0),
+                          item.get('lastHereAt', 0), generation, json.dumps(item['venue'])))
+            self.__index(conn, item['venue'])
+            position += 1
+        conn.commit()
+        conn.close()
+
+    def history_prune(self, generation):
+        conn = self.__connect()
+        conn.execute("DELETE FROM history WHERE generation != ?", (generation,))
+        conn.commit()
+        conn.close()
+
+    def history_merge(self, items):
+        """
+        Merges venuehistory items for a recent period of time: visit counts are
+        added to the stored ones, and the venues are moved to the top.
+        """
+        conn = self.__connect()
+        c = conn.cursor()
+        c.execute("SELECT MIN(position) FROM history")
+        top = c.fetchone()[0] or 0
+        position = top - len(items)
+        for item in items:
+            venueId = item['venue']['id']
+            c.execute("SELECT beenHere, lastHere, generation FROM history WHERE venue_id = ?", (venueId,))
+            row = c.fetchone()
+            beenHere = item.get('beenHere', 0)
+            lastHere = item.get('lastHereAt', 0)
+            generation = 0
+            if row:
+                beenHere += row[0]
+                lastHere = max(lastHere, row[1])
+                generation = row[2]
+            conn.execute("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?, ?)",
+                         (venueId, position, beenHere, lastHere, generation, json.dumps(item['venue'])))
+            self.__index(conn, item['venue'])
+            position += 1
+        conn.commit()
+        conn.close()
+
+    def history(self):
+        """
+        Returns the stored history, most recent first, in the same format as
+        venuehistory's items.
+        """
+        conn = self.__connect()
+        c = conn.cursor()
+        c.execute("SELECT beenHere, lastHere, venue FROM history ORDER BY position")
+        items = list()
+        for beenHere, lastHere, venue in c.fetchall():
+            items.append({'beenHere': beenHere, 'lastHereAt': lastHere, 'venue': json.loads(venue)})
+        conn.close()
+        return items
+
+
+if __name__ == "__main__":
+    # Benchmark of nearby queries over 10k and 100k stored venues
+    import os
+    import random
+    import tempfile
+
+    random.seed(0)
+    for count in (10000, 100000):
+        path = tempfile.mktemp(".sqlite")
+        store = LocalStore(path)
+        venues = []
+        for i in range(count):
+            venues.append({'id': "v%d" % i, 'name': "Venue %d" % i, 'categories': [],
+                           'location': {'lat': -34.6 + random.uniform(-0.3, 0.3), 'lng': -58.4 + random.uniform(-0.3, 0.3)}})
+        start = time.time()
+        store.venues_put(venues)
+        print "%d venues: stored in %.1fs" % (count, time.time() - start)
+
+        points = [(-34.6 + random.uniform(-0.25, 0.25), -58.4 + random.uniform(-0.25, 0.25)) for i in range(100)]
+        start = time.time()
+        for lat, lng in points:
+            store.within(*bounding_box(lat, lng, 500))
+        print "%d venues: %.2fms per 1km box" % (count, (time.time() - start) * 10)
+        start = time.time()
+        for lat, lng in points:
+            store.nearest(lat, lng, 25)
+        print "%d venues: %.2fms per 25 nearest" % (count, (time.time() - start) * 10)
+        os.remove(path)
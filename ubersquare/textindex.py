@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2012 Hugo Osvaldo Barrera <hugo@osvaldobarrera.com.ar>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import unicodedata
+import bisect
+import re
+
+_separators = re.compile(r"\W+", re.UNICODE)
+
+
+def fold(text):
+    """
+    Lowercases text and strips accents, so that "Café" matches "cafe".
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text.lower())
+    return u"".join([c for c in text if not unicodedata.combining(c)])
+
+
+def tokens(text):
+    return [token for token in _separators.split(fold(text)) if token]
+
+
+def trigrams(token):
+    return [token[i:i + 3] for i in range(len(token) - 2)]
+
+
+class TextIndex:
+    """
+    An in-memory index to find ids by words of their text.
+
+    Every word of a query must appear in an id's text.  Words shorter than
+    three letters must start a word in the text; longer ones may appear
+    anywhere (they're looked up by trigram).
+    """
+
+    def __init__(self, entries=()):
+        self.__tokens = []
+        self.__trigrams = dict()
+        self.__texts = dict()
+        self.__sorted = True
+        for id, text in entries:
+            self.add(id, text)
+
+    def add(self, id, text):
+        words = tokens(text)
+        self.__texts[id] = u" ".join(words)
+        for word in words:
+            self.__tokens.append((word, id))
+            for trigram in trigrams(word):
+                self.__trigrams.setdefault(trigram, set()).add(id)
+        self.__sorted = False
+
+    def __prefixed(self, prefix):
+        if not self.__sorted:
+            self.__tokens.sort()
+            self.__sorted = True
+        ids = set()
+        i = bisect.bisect_left(self.__tokens, (prefix,))
+        while i < len(self.__tokens) and self.__tokens[i][0].startswith(prefix):
+            ids.add(self.__tokens[i][1])
+            i += 1
+        return ids
+
+    def __containing(self, word):
+        ids = None
+        for trigram in trigrams(word):
+            found = self.__trigrams.get(trigram, set())
+            if ids is None:
+                ids = set(found)
+            else:
+                ids &= found
+            if not ids:
+                return set()
+        return set([id for id in ids if word in self.__texts[id]])
+
+    def search(self, query):
+        """
+        Returns the set of matching ids, or None if the query is empty (ie:
+        everything matches).
+        """
+        words = tokens(query)
+        if not words:
+            return None
+        ids = None
+        for word in words:
+            if len(word) < 3:
+                found = self.__prefixed(word)
+            else:
+                found = self.__containing(word)
+            if ids is None:
+                ids = found
+            else:
+                ids &= found
+            if not ids:
+                break
+        return ids
@@ -16,7 +16,7 @@
 
 from PySide.QtCore import QThread
 import foursquare
-import time
+from locationProviders import LocationProvider
 
 
 class VenueProviderThread(QThread):
@@ -29,32 +29,95 @@ class VenueProviderThread(QThread):
     def run(self):
         try:
             venues = self.source(foursquare.ForceFetch)
-            self.parentWindow.setVenues(venues)
+            self.venueWindow.deliverVenues(venues)
             self.parentWindow.hideWaitingDialog.emit()
             self.venueWindow.updateVenues.emit()
         except IOError:
             self.parentWindow.networkError.emit()
 
 
+class VenuePagesThread(VenueProviderThread):
+    """
+    Like VenueProviderThread, but source is a generator that yields one page of
+    venues at a time.  If progressive, the first page is shown as soon as it
+    arrives, and the rest are appended to venueWindow as they come in;
+    otherwise (ie: when refreshing a list that's already on screen) the list
+    is replaced once all pages have arrived.
+    """
+    def __init__(self, venueWindow, source, parent, progressive=True):
+        super(VenuePagesThread, self).__init__(venueWindow, source, parent)
+        self.progressive = progressive
+
+    def run(self):
+        try:
+            venues = None
+            for page in self.source(foursquare.ForceFetch):
+                if not self.progressive:
+                    venues = foursquare.join_venue_arrays(venues, page)
+                elif venues is None:
+                    venues = page
+                    self.venueWindow.deliverVenues(venues)
+                    self.parentWindow.hideWaitingDialog.emit()
+                    self.venueWindow.updateVenues.emit()
+                else:
+                    self.venueWindow.queueVenues(page)
+                    self.venueWindow.venuesArrived.emit()
+            if not self.progressive and venues is not None:
+                self.venueWindow.deliverVenues(venues)
+                self.venueWindow.updateVenues.emit()
+            self.parentWindow.hideWaitingDialog.emit()
+        except IOError:
+            self.parentWindow.networkError.emit()
+
+
 class VenueSearchThread(VenueProviderThread):
-    def __init__(self, venueWindow, source, venueName, ll, categoryId, limit, parent):
+    """
+    Searches venues on foursquare.  Venues in local (ie: those that were
+    found locally and already shown) that foursquare didn't return are kept
+    after the remote results.
+    """
+    def __init__(self, venueWindow, source, venueName, ll, categoryId, limit, parent, local=None):
         super(VenueSearchThread, self).__init__(venueWindow, source, parent)
         self.venueWindow = venueWindow
         self.venueName = venueName
         self.ll = ll
         self.categoryId = categoryId
         self.limit = limit
+        self.local = local
 
     def run(self):
         try:
             venues = self.source(self.venueName, self.ll, self.categoryId, self.limit, foursquare.ForceFetch)
-            self.parentWindow.setVenues(venues)
+            self.venueWindow.deliverVenues(foursquare.merge_venue_arrays(venues, self.local))
             self.parentWindow.hideWaitingDialog.emit()
             self.venueWindow.updateVenues.emit()
         except IOError:
             self.parentWindow.networkError.emit()
 
 
+class LiveSearchThread(QThread):
+    """
+    Runs one search-as-you-type query.
+    venueWindow must implement:
+     - searchResult(query, venues) (venues is None if the search failed)
+     - searchDone
+    """
+    def __init__(self, venueWindow, search, query):
+        super(LiveSearchThread, self).__init__(venueWindow)
+        self.venueWindow = venueWindow
+        self.search = search
+        self.query = query
+
+    def run(self):
+        venues = None
+        try:
+            venues = self.search(self.query)
+        except IOError, e:
+            print "Live search for %s failed (%s)" % (self.query, e)
+        self.venueWindow.searchResult(self.query, venues)
+        self.venueWindow.searchDone.emit()
+
+
 class UserUpdaterThread(QThread):
     def __init__(self, target, source, parent):
         super(UserUpdaterThread, self).__init__(parent)
@@ -79,6 +142,7 @@ class ImageCacheThread(QThread):
         self.__parent = parent
 
     def run(self):
+        foursquare.set_priority(foursquare.Priority.Background)
         try:
             foursquare.init_category_icon_cache()
             self.__parent.hideWaitingDialog.emit()
@@ -96,7 +160,11 @@ class TipMarkDoneBackgroundThread(QThread):
 
     def run(self):
         try:
-            foursquare.tip_markdone(self.tipId, self.marked)
+            outcome, response = foursquare.tip_markdone(self.tipId, self.marked)
+            if outcome == foursquare.Posted.Queued:
+                self.parentWindow.queued.emit()
+            elif outcome == foursquare.Posted.Rejected:
+                self.parentWindow.rejected.emit()
         except IOError:
             self.parentWindow.networkError.emit()
 
@@ -110,7 +178,11 @@ class TipMarkTodoBackgroundThread(QThread):
 
     def run(self):
         try:
-            foursquare.tip_marktodo(self.tipId, self.marked)
+            outcome, response = foursquare.tip_marktodo(self.tipId, self.marked)
+            if outcome == foursquare.Posted.Queued:
+                self.parentWindow.queued.emit()
+            elif outcome == foursquare.Posted.Rejected:
+                self.parentWindow.rejected.emit()
         except IOError:
             self.parentWindow.networkError.emit()
 
@@ -137,14 +209,25 @@ class LeaveTipThread(QThread):
 
     def run(self):
         try:
-            foursquare.tip_add(self.venueId, self.text)
+            outcome, response = foursquare.tip_add(self.venueId, self.text)
             self.parentWindow.hideWaitingDialog.emit()
-            self.parentWindow.showMoreInfo.emit()
+            if outcome == foursquare.Posted.Delivered:
+                self.parentWindow.cacheUpdated.emit()
+            elif outcome == foursquare.Posted.Queued:
+                self.parentWindow.queued.emit()
+            else:
+                self.parentWindow.rejected.emit()
         except IOError:
             self.parentWindow.networkError.emit()
 
 
 class VenueDetailsThread(QThread):
+    """
+    Fetches a venue's full details into the cache.
+    parent must implement:
+     - detailsFetched (emitted whether the fetch worked or not)
+     - networkError
+    """
     def __init__(self, venueId, parent):
         super(VenueDetailsThread, self).__init__(parent)
         self.__parent = parent
@@ -152,20 +235,15 @@ class VenueDetailsThread(QThread):
 
     def run(self):
         try:
-            venue = foursquare.venues_venue(self.venueId, foursquare.ForceFetch)
-            if 'mayor' in venue:
-                if 'user' in venue['mayor']:
-                    print "there's a mayor!"
-                    foursquare.image(venue['mayor']['user']['photo'])
-            self.__parent.hideWaitingDialog.emit()
-            # This tiny sleep in necesary to (a) Avoid an Xorg warning, (b) achieve a smoother transition
-            time.sleep(0.15)
-            self.__parent.showMoreInfo.emit()
-        except IOError:
-            self.__parent.hideWaitingDialog.emit()
-            self.__parent.networkError.emit()
-        self.exec_()
-        self.exit(0)
+            try:
+                venue = foursquare.venues_venue(self.venueId, foursquare.ForceFetch)
+                if venue and 'mayor' in venue:
+                    if 'user' in venue['mayor']:
+                        foursquare.image(venue['mayor']['user']['photo'])
+            except IOError:
+                self.__parent.networkError.emit()
+        finally:
+            self.__parent.detailsFetched.emit()
 
 class UserDetailsThread(QThread):
     def __init__(self, userId, parent):
@@ -197,12 +275,9 @@ class UserDetailsThread(QThread):
 
 class UserMayorships(QThread):
     """
-    Retrieves a user's mayorships. "parent" should implement:
-    the method
-     - "setVenues"
+    Retrieves a user's mayorships into venueWindow. "parent" should implement:
     the signals
      - "hideWaitingDialog"
-     - "updateVenues"
      - "networkError"
     """
     def __init__(self, venueWindow, userId, parent):
@@ -213,7 +288,7 @@ class UserMayorships(QThread):
 
     def run(self, cacheMode = foursquare.Cache.ForceFetch):
         try:
-            self.__parent.setVenues(self.getVenues(cacheMode))
+            self.__venueWindow.deliverVenues(self.getVenues(cacheMode))
             self.__parent.hideWaitingDialog.emit()
             self.__venueWindow.updateVenues.emit()
         except IOError:
@@ -225,9 +300,12 @@ class UserMayorships(QThread):
 
 class CheckinThread(QThread):
     """
-    Checks-in into a venue.
+    Checks-in into a venue.  If the checkin has no ll, the location is
+    looked up first (see LocationProvider.fix).
     parent must implement:
      - checkinDone
+     - queued
+     - rejected
      - networkError
     """
 
@@ -238,7 +316,16 @@ class CheckinThread(QThread):
 
     def run(self):
         try:
-            response = foursquare.checkin(self.__checkin)
-            self.__parent.checkinDone.emit(response)
+            if self.__checkin.ll is None:
+                fix = LocationProvider().fix(self.__checkin.venue)
+                if fix is not None:
+                    self.__checkin.ll = fix.ll
+            outcome, response = foursquare.checkin(self.__checkin)
+            if outcome == foursquare.Posted.Delivered:
+                self.__parent.checkinDone.emit(response)
+            elif outcome == foursquare.Posted.Queued:
+                self.__parent.queued.emit()
+            else:
+                self.__parent.rejected.emit()
         except IOError:
             self.__parent.networkError.emit()
@@ -15,19 +15,19 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 from PySide.QtGui import QListView, QWidget, QVBoxLayout, QLineEdit, QIcon, QScrollArea, QGridLayout, QLabel, QImage, QPixmap, QPushButton, QSortFilterProxyModel, QDialog
-from PySide.QtCore import QAbstractListModel, Qt, Signal, SIGNAL
+from PySide.QtCore import Qt, Signal, SIGNAL
 from PySide.QtMaemo5 import QMaemo5InformationBox
 
 
-from custom_widgets import UberSquareWindow, Title
-from threads import UserDetailsThread, UserMayorships
+from custom_widgets import UberSquareWindow, Title, RowListModel, FilteredListView, FilterField, icon
+from rows import user_rows
+from threads import UserDetailsThread, UserMayorships, CheckinThread
 from venues import VenueListWindow
 import foursquare
 from datetime import datetime
 import time
 
-from venues import CheckinConfirmation, CheckinDetails
-from locationProviders import LocationProvider
+from venues import CheckinConfirmation, CheckinDetails, Checkin
 
 
 class UserProfile(QWidget):
@@ -160,6 +160,9 @@ class UserDetailsWindow(UberSquareWindow):
         showUser = Signal()
         self.connect(self, SIGNAL("showUser()"), self.__showUser)
 
+        self.checkinDone = Signal()
+        self.connect(self, SIGNAL("checkinDone(str)"), self.__checkinDone)
+
     def __update(self):
         print "updating..."
         t = UserDetailsThread(self.user['user']['id'], self)
@@ -181,13 +184,13 @@ class UserDetailsWindow(UberSquareWindow):
         c = CheckinConfirmation(self, venue)
         c.exec_()
         if c.result() == QDialog.Accepted:
-            try:
-                # TODO: do this in a separate thread
-                ll = LocationProvider().get_ll(venue)
-                response = foursquare.checkin(venue, ll, self.shoutText.text(), c.broadcast())
-                CheckinDetails(self, response).show()
-            except IOError:
-                self.networkError.emit()
+            QMaemo5InformationBox.information(self, "Checking in...")
+            # The location is looked up by the thread
+            checkin = Checkin(venue, None, self.shoutText.text(), c.broadcast())
+            CheckinThread(checkin, self).start()
+
+    def __checkinDone(self, response):
+        CheckinDetails(self, response).show()
 
     def mayorships_pushed(self):
         # TODO: show user's name
@@ -197,84 +200,56 @@ class UserDetailsWindow(UberSquareWindow):
         venues = dataSource.getVenues(foursquare.Cache.CacheOrNull)
         dataSource.start()
         if venues:
-            self.setVenues(venues)
+            venueListWindow.deliverVenues(venues)
             venueListWindow.updateVenues.emit()
         else:
             self.showWaitingDialog.emit()
 
-    def setVenues(self, venues):
-        self.__venues = venues
-
-    def venues(self):
-        return self.__venues
-
 
 #################
 ### User List ###
 #################
 
 
-class UserListModel(QAbstractListModel):
+class UserListModel(RowListModel):
     """
     The model which contains the users.
     """
     def __init__(self, users):
-        super(UserListModel, self).__init__()
-        self.users = users
+        super(UserListModel, self).__init__(user_rows(users))
 
     UserRole = 54514533
 
-    def rowCount(self, role=Qt.DisplayRole):
-        if self.users:
-            return len(self.users)
-        else:
-            return 0
-
     def data(self, index, role=Qt.DisplayRole):
-        user = self.users[index.row()]['user']
+        row = self.rows[index.row()]
         if role == Qt.DisplayRole:
-            text = user['firstName']
-            if 'lastName' in user:
-                text += " " + user['lastName']
-            score = self.users[index.row()]['scores']
-            text += "\n  " + str(score['recent']) + "/" + str(score['max']) + " (" + str(score['checkinsCount']) + " checkins" + ")"
-            return text
+            return row.display
         elif role == Qt.DecorationRole:
-            return QIcon(foursquare.image(user['photo']))
+            return icon(row.icon)
         elif role == UserListModel.UserRole:
-            return self.users[index.row()]
+            return row.user
 
     def setUsers(self, users):
-        self.users = users
-        self.reset()
+        self.setRows(user_rows(users))
 
 
-class UserListWidget(QListView):
+class UserListWidget(FilteredListView):
     """
     This actual widget that shows the list of users.
     It contains a proxy that, in turn, contains a UserListModel.
     """
     def __init__(self, users, parent):
-        super(UserListWidget, self).__init__(parent)
-        self.model = UserListModel(users)
-
-        self.proxy = QSortFilterProxyModel(self)
-        self.proxy.setSourceModel(self.model)
-        self.proxy.setFilterCaseSensitivity(Qt.CaseInsensitive)
-        self.setModel(self.proxy)
+        super(UserListWidget, self).__init__(UserListModel(users), parent)
 
         self.clicked.connect(parent.user_selected)
         self.adjustSize()
     
     def setUsers(self, users):
         self.model.setUsers(users)
+        self.refilter()
 
     def getUser(self, index):
-        return self.model.data(index, UserListModel.UserRole)
-
-    def filter(self, text):
-        self.proxy.setFilterRegExp(text)
-        self.proxy.filterRegExp()
+        return self.proxy.data(index, UserListModel.UserRole)
 
 
 class UserListWindow(UberSquareWindow):
@@ -291,12 +266,9 @@ class UserListWindow(UberSquareWindow):
 
         layout = QVBoxLayout(self.cw)
 
-        self.text_field = QLineEdit(self)
-        self.text_field.setPlaceholderText("Type to filter")
+        self.text_field = FilterField(self.filter, self)
         self.list = UserListWidget(users, self)
 
-        self.text_field.textChanged.connect(self.filter)
-
         layout.addWidget(self.text_field)
         layout.addWidget(self.list)
 
@@ -19,175 +19,500 @@ from PySide.QtCore import *
 from PySide.QtGui import *
 from foursquare import Cache
 from locationProviders import LocationProvider
-from custom_widgets import CategorySelector, UberSquareWindow, Ruler, Title
-from threads import TipMarkTodoBackgroundThread, TipMarkDoneBackgroundThread, LeaveTipThread, VenueDetailsThread, CheckinThread
+from custom_widgets import CategorySelector, UberSquareWindow, Ruler, Title, RowListModel, FilteredListView, FilterField, icon
+from threads import TipMarkTodoBackgroundThread, TipMarkDoneBackgroundThread, LeaveTipThread, VenueDetailsThread, CheckinThread, LiveSearchThread
 from PySide.QtMaemo5 import *
 from checkins import CheckinConfirmation, CheckinDetails, Checkin
+import rows
+from rows import venue_rows, venue_distances, tip_rows
+from geo import parse_ll, distance
 
 import foursquare
+import objects
 
 
-class VenueListModel(QAbstractListModel):
+class VenueListModel(RowListModel):
 	"""
 	The inner model user to contain the list of venues.
+	Venues are turned into VenueRows once, when they're set, so that data()
+	doesn't do any work.  Distances from the origin are calculated for all
+	rows at once, when either changes (see rows.venue_distances).
 	"""
 	def __init__(self, venues):
-		super(VenueListModel, self).__init__()
-		self.venues = venues
+		super(VenueListModel, self).__init__(venue_rows(venues))
+		self.origin = None
+		self.distances = None
 
-	VenueRole = 849561745
+	VenueRole = rows.VenueRole
+	DistanceRole = rows.DistanceRole
 
-	def rowCount(self, role=Qt.DisplayRole):
-		if self.venues:
-			return len(self.venues)
-		else:
-			return 0
+	# See rows.py, where it's benchmarked
+	data = rows.venue_data
 
-	def data(self, index, role=Qt.DisplayRole):
-		venue = self.venues[index.row()]['venue']
-		if role == Qt.DisplayRole:
-			name = venue['name']
-			if len(name) > 72:
-				name = name[0:70]
-			address = "(no address)"
-			if 'address' in venue['location']:
-				address = venue['location']['address']
-				if len(address) > 72:
-					address = address[0:70]
-			distance = ""
-			if 'distance' in venue['location']:
-				distance = " (" + str(venue['location']['distance']) + " metres away)"
-			return name + "\n  " + address + distance
-		elif role == Qt.DecorationRole:
-			if len(venue['categories']) > 0:
-				prefix = venue['categories'][0]['icon']['prefix']
-				extension = venue['categories'][0]['icon']['name']
-				image_url = prefix + "64" + extension
-			else:
-				image_url = "https://foursquare.com/img/categories/none_64.png"
-			return QIcon(foursquare.image(image_url))
-			
-		elif role == VenueListModel.VenueRole:
-			return venue
+	def rowIcon(self, url):
+		return icon(url)
 
 	def setVenues(self, venues):
-		self.venues = venues
-		self.reset()
-
-
-class VenueList(QListView):
+		rows = venue_rows(venues)
+		if self.origin is not None:
+			self.distances = venue_distances(rows, self.origin)
+		self.setRows(rows)
+
+	def appendVenues(self, venues):
+		rows = venue_rows(venues)
+		if self.origin is not None:
+			self.distances.update(venue_distances(rows, self.origin))
+		self.appendRows(rows)
+
+	def setOrigin(self, lat, lng):
+		"""
+		Makes distances be from (lat, lng).  Only rows whose distance changed
+		are updated (and, if sorted by distance, moved).
+		"""
+		self.origin = (lat, lng)
+		old = self.distances or dict()
+		self.distances = venue_distances(self.rows, self.origin)
+		first = None
+		for i in range(len(self.rows) + 1):
+			changed = i < len(self.rows) and old.get(self.rows[i].id) != self.distances.get(self.rows[i].id)
+			if changed and first is None:
+				first = i
+			elif not changed and first is not None:
+				self.dataChanged.emit(self.index(first), self.index(i - 1))
+				first = None
+
+
+class VenueList(FilteredListView):
 	"""
 	The list widget, that actually shows the list of venues
 	"""
 	def __init__(self, parent, venues):
-		super(VenueList, self).__init__(parent)
-		self.model = VenueListModel(venues)
-
-		self.proxy = QSortFilterProxyModel(self)
-		self.proxy.setSourceModel(self.model)
-		self.proxy.setFilterCaseSensitivity(Qt.CaseInsensitive)
-		self.setModel(self.proxy)
+		super(VenueList, self).__init__(VenueListModel(venues), parent)
 
 		self.clicked.connect(self.venue_selected)
 
+		# Once the list stays still for a moment, the venues on screen are
+		# prefetched, so that opening one rarely has to wait
+		self.prefetchTimer = QTimer(self)
+		self.prefetchTimer.setSingleShot(True)
+		self.prefetchTimer.setInterval(1000)
+		self.prefetchTimer.timeout.connect(self.prefetchVisible)
+		self.verticalScrollBar().valueChanged.connect(self.__changed)
+		self.proxy.layoutChanged.connect(self.__changed)
+		self.proxy.modelReset.connect(self.__changed)
+		self.proxy.rowsInserted.connect(self.__changed)
+
+	def __changed(self, *args):
+		self.prefetchTimer.start()
+
+	def prefetchVisible(self):
+		if not self.isVisible():
+			return
+		rect = self.viewport().rect()
+		first = self.indexAt(rect.topLeft())
+		if not first.isValid():
+			return
+		last = self.indexAt(rect.bottomLeft())
+		if last.isValid():
+			last = last.row()
+		else:
+			last = self.proxy.rowCount() - 1
+		venueIds = list()
+		for row in range(first.row(), last + 1):
+			venueIds.append(self.proxy.data(self.proxy.index(row, 0), VenueListModel.VenueRole))
+		foursquare.prefetch_venues(venueIds)
+
 	def venue_selected(self, index):
-		venue = self.proxy.data(index, VenueListModel.VenueRole)
-		cachedVenue = foursquare.venues_venue(venue['id'], foursquare.CacheOnly)
+		venueId = self.proxy.data(index, VenueListModel.VenueRole)
+		cachedVenue = foursquare.venues_venue(venueId, foursquare.CacheOnly)
 		if not cachedVenue:
+			venue = foursquare.stored_venue(venueId)
+			if venue is None:
+				# ie: the store was pruned; the window fetches the rest
+				venue = self.model.rows[self.proxy.mapToSource(index).row()].record()
 			d = VenueDetailsWindow(self, venue, False)
 		else:
 			d = VenueDetailsWindow(self, cachedVenue, True)
 		d.show()
 
-	def filter(self, text):
-		self.proxy.setFilterRegExp(text)
-		self.proxy.filterRegExp()
-
 	def setVenues(self, venues):
 		self.model.setVenues(venues)
+		self.refilter()
+
+	def appendVenues(self, venues):
+		self.model.appendVenues(venues)
+		self.refilter()
+
+	def setOrigin(self, lat, lng):
+		self.model.setOrigin(lat, lng)
+
+	def sortByDistance(self, enabled):
+		self.proxy.setSortRole(VenueListModel.DistanceRole)
+		self.proxy.setDynamicSortFilter(True)
+		if enabled:
+			self.proxy.sort(0)
+		else:
+			self.proxy.sort(-1)
 
 
 class VenueListWindow(UberSquareWindow):
+	# How often to check whether we've moved, in milliseconds
+	LOCATION_INTERVAL = 15000
+	# How far to move before distances are recalculated, in metres
+	LOCATION_THRESHOLD = 20
+	# How long typing must pause before a live search is sent, in milliseconds
+	SEARCH_DELAY = 600
+
 	def __init__(self, title, venues, parent):
 		super(VenueListWindow, self).__init__(parent)
 
 		self.setWindowTitle(title)
 
+		sortByDistance = QAction(self)
+		sortByDistance.setText("Sort by distance")
+		sortByDistance.setCheckable(True)
+		sortByDistance.toggled.connect(self.sortByDistance)
+		menubar = QMenuBar(self)
+		self.setMenuBar(menubar)
+		menubar.addAction(sortByDistance)
+
+		self.origin = None
+		self.__fix = None
+		self.__locating = False
+		locationFound = Signal()
+		self.connect(self, SIGNAL("locationFound()"), self.__locationFound)
+		self.locationTimer = QTimer(self)
+		self.locationTimer.setInterval(VenueListWindow.LOCATION_INTERVAL)
+		self.locationTimer.timeout.connect(self.updateLocation)
+		self.locationTimer.start()
+		QTimer.singleShot(0, self.updateLocation)
+
 		self.cw = QWidget(self)
 		self.setCentralWidget(self.cw)
 
 		layout = QVBoxLayout(self.cw)
 
-		self.text_field = QLineEdit(self)
-		#QPlainTextEdit es multilinea
-		self.text_field.setPlaceholderText("Type to filter")
+		self.text_field = FilterField(self.filter, self)
 		self.list = VenueList(self, venues)
 
-		self.text_field.textChanged.connect(self.filter)
-
 		layout.addWidget(self.text_field)
 		layout.addWidget(self.list)
 
 		updateVenues = Signal()
 		self.connect(self, SIGNAL("updateVenues()"), self._updateVenues)
 
+		# Venues fetched by a thread, for _updateVenues to show
+		self.__delivered = None
+		# Further pages of venues, queued by VenuePagesThread
+		self.__pending = []
+		venuesArrived = Signal()
+		self.connect(self, SIGNAL("venuesArrived()"), self._appendVenues)
+
+		# What live searches started from (see enableLiveSearch)
+		self.__remoteSearch = None
+		self.__remoteVenues = None
+
+	def enableLiveSearch(self, remote, local, venues):
+		"""
+		Makes the filter field search as the user types.  local(text) is
+		called right away, and its venues are shown along with the last
+		remote results (venues, to begin with).  remote(text) runs in a
+		thread, once typing pauses; at most one runs at a time, and only the
+		latest text waits for it.
+		"""
+		self.__remoteSearch = remote
+		self.__remoteVenues = venues
+		self.__localSearch = local
+		self.__searching = None
+		self.__nextQuery = None
+		self.__result = None
+
+		self.searchTimer = QTimer(self)
+		self.searchTimer.setSingleShot(True)
+		self.searchTimer.setInterval(VenueListWindow.SEARCH_DELAY)
+		self.searchTimer.timeout.connect(self.__startSearch)
+
+		searchDone = Signal()
+		self.connect(self, SIGNAL("searchDone()"), self.__searchDone)
+
+		self.text_field.setPlaceholderText("Type to search")
+
+	def __startSearch(self):
+		if self.__searching is not None or self.__nextQuery is None:
+			return
+		self.__searching = self.__nextQuery
+		self.__nextQuery = None
+		self.setAttribute(Qt.WA_Maemo5ShowProgressIndicator, True)
+		LiveSearchThread(self, self.__remoteSearch, self.__searching).start()
+
+	def searchResult(self, query, venues):
+		self.__result = (query, venues)
+
+	def __searchDone(self):
+		query, venues = self.__result
+		self.__searching = None
+		if venues:
+			# Streamed in even if the text changed meanwhile; it's still closer
+			# to it than what's shown
+			self.setVenues(venues)
+			local = self.__localSearch(self.text_field.text())
+			if local:
+				self.list.setVenues(foursquare.merge_venue_arrays(venues, local))
+		if self.__nextQuery is not None and not self.searchTimer.isActive():
+			self.__startSearch()
+		if self.__searching is None:
+			self.setAttribute(Qt.WA_Maemo5ShowProgressIndicator, False)
+
+	def deliverVenues(self, venues):
+		"""
+		Hands over venues for the next updateVenues to show.  Only the list
+		keeps them after that.
+		"""
+		self.__delivered = venues
+
 	def _updateVenues(self):
-		self.setVenues(self.parent().venues())
+		venues = self.__delivered
+		self.__delivered = None
+		self.setVenues(venues)
 		if not self.shown:
 			self.show()
 		else:
 			QMaemo5InformationBox.information(self, "Venue list updated")
 
+	def queueVenues(self, venues):
+		self.__pending.append(venues)
+
+	def _appendVenues(self):
+		while self.__pending:
+			self.list.appendVenues(self.__pending.pop(0))
+
 	def filter(self, text):
+		if self.__remoteSearch is not None and text:
+			local = self.__localSearch(text)
+			if local:
+				self.list.setVenues(foursquare.merge_venue_arrays(self.__remoteVenues, local))
+			self.__nextQuery = text
+			self.searchTimer.start()
 		self.list.filter(text)
 
 	def setVenues(self, venues):
+		if self.__remoteSearch is not None:
+			self.__remoteVenues = venues
 		self.list.setVenues(venues)
 
+	def sortByDistance(self, enabled):
+		self.list.sortByDistance(enabled)
+
+	def updateLocation(self):
+		"""
+		Recalculates distances to all venues if we've moved far enough.
+		"""
+		if self.__locating or (self.shown and not self.isVisible()):
+			return
+		self.__locating = True
+		# This runs every few seconds, so it must never ask foursquare
+		LocationProvider().locate(self.__located, offline=True)
+
+	def __located(self, fix):
+		# May be called from a background thread (see LocationProvider.locate)
+		self.__fix = fix
+		self.locationFound.emit()
+
+	def __locationFound(self):
+		self.__locating = False
+		if self.__fix is None:
+			return
+		origin = parse_ll(self.__fix.ll)
+		if not origin:
+			return
+		if self.origin and distance(self.origin[0], self.origin[1], origin[0], origin[1]) < VenueListWindow.LOCATION_THRESHOLD:
+			return
+		self.origin = origin
+		self.list.setOrigin(origin[0], origin[1])
+
+
+class TipListModel(RowListModel):
+	"""
+	The tips of a venue (as TipRows).
+	"""
+	TipRole = 849561747
+
+	def data(self, index, role=Qt.DisplayRole):
+		row = self.rows[index.row()]
+		if role == Qt.DisplayRole:
+			return row.text
+		elif role == TipListModel.TipRole:
+			return row
+
+	def flags(self, index):
+		return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+
+	def rowChanged(self, row):
+		"""
+		Notifies views that the tip in row (ie: an editor's) changed.  The rows
+		may have been replaced since the editor was created, so it's looked up
+		by id, and takes the place of the current row for that tip.
+		"""
+		for i in range(len(self.rows)):
+			if self.rows[i].id == row.id:
+				self.rows[i] = row
+				index = self.index(i)
+				self.dataChanged.emit(index, index)
+				return
+
 
 class Tip(QWidget):
-	def __init__(self, tip, parent=None):
+	"""
+	The controls to mark a tip as done or to-do.  These are only created for
+	the tip that's being edited (see TipDelegate).
+	"""
+	def __init__(self, row, model, parent=None):
 		super(Tip, self).__init__(parent)
+		self.setAutoFillBackground(True)
 
 		gridLayout = QGridLayout()
+		gridLayout.setContentsMargins(0, 0, 0, 0)
 		self.setLayout(gridLayout)
-		self.tip = tip
+		self.row = row
+		self.model = model
 
-		tipLabel = QLabel(tip['text'], self)
+		# Rows only fit a few lines (see TipDelegate); the whole tip can be
+		# scrolled through here
+		tipLabel = QLabel(row.text)
 		tipLabel.setWordWrap(True)
-		gridLayout.addWidget(tipLabel, 0, 0, 2, 1)
-
-		self.done_checkbox = QCheckBox("Done! (" + str(tip['done']['count']) + ")")
-		self.done_checkbox.setChecked(self.isTipDone())
+		tipLabel.setAlignment(Qt.AlignLeft | Qt.AlignTop)
+		scrollArea = QScrollArea(self)
+		scrollArea.setWidget(tipLabel)
+		scrollArea.setWidgetResizable(True)
+		scrollArea.setFrameShape(QFrame.NoFrame)
+		scrollArea.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+		gridLayout.addWidget(scrollArea, 0, 0, 2, 1)
+
+		self.done_checkbox = QCheckBox("Done! (" + str(row.doneCount) + ")")
+		self.done_checkbox.setChecked(row.done)
 		self.done_checkbox.stateChanged.connect(self.markDone)
 
-		self.todo_checkbox = QCheckBox("To-do (" + str(tip['todo']['count']) + ")")
-		self.todo_checkbox.setChecked(self.isTipTodo())
+		self.todo_checkbox = QCheckBox("To-do (" + str(row.todoCount) + ")")
+		self.todo_checkbox.setChecked(row.todo)
 		self.todo_checkbox.stateChanged.connect(self.markTodo)
 
 		gridLayout.addWidget(self.done_checkbox, 0, 1, 1, 1)
 		gridLayout.addWidget(self.todo_checkbox, 1, 1, 1, 1)
 		gridLayout.setColumnStretch(0, 1)
 
-	def isTipInGroupType(self, groupType):
-		if 'listed' in self.tip:
-			if 'groups' in self.tip['listed']:
-				for group in self.tip['listed']['groups']:
-					if group['type'] == groupType:
-						return True
-		return False
+	def markTodo(self, state):
+		self.row.todo = self.todo_checkbox.isChecked()
+		self.row.todoCount = max(self.row.todoCount + (self.row.todo and 1 or -1), 0)
+		self.todo_checkbox.setText("To-do (" + str(self.row.todoCount) + ")")
+		self.model.rowChanged(self.row)
+		TipMarkTodoBackgroundThread(self.row.id, self.row.todo, self.window()).start()
 
-	def isTipDone(self):
-		return self.isTipInGroupType("dones")
+	def markDone(self, state):
+		self.row.done = self.done_checkbox.isChecked()
+		self.row.doneCount = max(self.row.doneCount + (self.row.done and 1 or -1), 0)
+		self.done_checkbox.setText("Done! (" + str(self.row.doneCount) + ")")
+		self.model.rowChanged(self.row)
+		TipMarkDoneBackgroundThread(self.row.id, self.row.done, self.window()).start()
 
-	def isTipTodo(self):
-		return self.isTipInGroupType("todos")
 
-	def markTodo(self, state):
-		TipMarkTodoBackgroundThread(self.tip['id'], self.todo_checkbox.isChecked(), self).start()
+class TipDelegate(QStyledItemDelegate):
+	"""
+	Paints tips, so that the list only costs as much as the rows on screen.
+	The tip's checkboxes are just painted too; the actual controls are
+	created when a tip is clicked.  All rows are LINES tall, so that laying
+	the list out doesn't measure every tip; longer tips are shown whole in
+	the editor.
+	"""
+	LINES = 3
+	MARGIN = 6
+
+	def __init__(self, parent):
+		super(TipDelegate, self).__init__(parent)
+		checkbox = QCheckBox("To-do (0)")
+		self.__checkboxSize = checkbox.sizeHint()
+		textHeight = parent.fontMetrics().lineSpacing() * TipDelegate.LINES
+		self.__rowHeight = max(textHeight, self.__checkboxSize.height() * 2) + TipDelegate.MARGIN * 2
+
+	def rowHeight(self):
+		return self.__rowHeight
+
+	def sizeHint(self, option, index):
+		return QSize(option.rect.width(), self.__rowHeight)
+
+	def paint(self, painter, option, index):
+		row = index.data(TipListModel.TipRole)
+		painter.save()
+		if option.state & QStyle.State_Selected:
+			painter.fillRect(option.rect, option.palette.highlight())
+
+		rect = option.rect.adjusted(TipDelegate.MARGIN, TipDelegate.MARGIN, -TipDelegate.MARGIN, -TipDelegate.MARGIN)
+		controlsWidth = self.__checkboxSize.width()
+		textRect = rect.adjusted(0, 0, -controlsWidth - TipDelegate.MARGIN, 0)
+		painter.setPen(option.palette.text().color())
+		flags = Qt.AlignLeft | Qt.AlignTop | Qt.TextWordWrap
+		painter.drawText(textRect, flags, row.text)
+		# Tips that don't fit are continued in the editor
+		if option.fontMetrics.boundingRect(textRect, flags, row.text).height() > textRect.height():
+			painter.drawText(textRect, Qt.AlignRight | Qt.AlignBottom, u"\u2026")
+
+		style = QApplication.style()
+		top = rect.top()
+		for checked, text in ((row.done, "Done! (" + str(row.doneCount) + ")"),
+				(row.todo, "To-do (" + str(row.todoCount) + ")")):
+			button = QStyleOptionButton()
+			button.rect = QRect(rect.right() - controlsWidth, top, controlsWidth, self.__checkboxSize.height())
+			button.text = text
+			button.palette = option.palette
+			button.state = QStyle.State_Enabled
+			if checked:
+				button.state |= QStyle.State_On
+			else:
+				button.state |= QStyle.State_Off
+			style.drawControl(QStyle.CE_CheckBox, button, painter)
+			top += self.__checkboxSize.height()
 
-	def markDone(self, state):
-		TipMarkDoneBackgroundThread(self.tip['id'], self.done_checkbox.isChecked(), self).start()
+		painter.setPen(option.palette.mid().color())
+		painter.drawLine(option.rect.left() + option.rect.width() / 4, option.rect.bottom(),
+			option.rect.right() - option.rect.width() / 4, option.rect.bottom())
+		painter.restore()
+
+	def createEditor(self, parent, option, index):
+		return Tip(index.data(TipListModel.TipRole), index.model(), parent)
+
+	def setEditorData(self, editor, index):
+		pass
+
+	def setModelData(self, editor, model, index):
+		pass
+
+	def updateEditorGeometry(self, editor, option, index):
+		editor.setGeometry(option.rect.adjusted(TipDelegate.MARGIN, TipDelegate.MARGIN, -TipDelegate.MARGIN, -TipDelegate.MARGIN))
+
+
+class TipList(QListView):
+	"""
+	A list of tips, that shows up to VISIBLE of them at a time.
+	"""
+	VISIBLE = 4
+
+	def __init__(self, rows, parent=None):
+		super(TipList, self).__init__(parent)
+		self.model = TipListModel(rows)
+		self.setModel(self.model)
+		self.delegate = TipDelegate(self)
+		self.setItemDelegate(self.delegate)
+		self.setUniformItemSizes(True)
+		self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+		self.setEditTriggers(QAbstractItemView.CurrentChanged | QAbstractItemView.SelectedClicked)
+		self.__fitHeight()
+
+	def setRows(self, rows):
+		self.model.setRows(rows)
+		self.__fitHeight()
+
+	def __fitHeight(self):
+		visible = min(len(self.model.rows), TipList.VISIBLE)
+		self.setFixedHeight(visible * self.delegate.rowHeight() + self.frameWidth() * 2)
 
 
 class NewTipWidget(QWidget):
@@ -214,13 +539,14 @@ class NewTipWidget(QWidget):
 
 
 class VenueDetailsWindow(UberSquareWindow):
+	"""
+	Shows whatever is known about a venue straight away (ie: the compact venue
+	from a list), and fills in the rest of the sections in place once the full
+	details arrive.
+	"""
 	def __init__(self, parent, venue, fullDetails):
 		super(VenueDetailsWindow, self).__init__(parent)
-		self.venue = venue
-
-		self.fullDetails = fullDetails
-
-		self.setWindowTitle(venue['name'])
+		self.fetching = False
 
 		self.centralWidget = QWidget()
 		self.setCentralWidget(self.centralWidget)
@@ -243,84 +569,124 @@ class VenueDetailsWindow(UberSquareWindow):
 		gridLayout = QGridLayout()
 		self.container.setLayout(gridLayout)
 
-		# name
-		name = venue['name']
-		if len(venue['categories']) > 0:
-			name += " (" + venue['categories'][0]['name'] + ")"
-
-		# address
-		address = ""
-		if 'address' in venue['location']:
-			address = venue['location']['address']
-
-		if 'crossStreet' in venue['location']:
-			if address != "":
-				address += ", "
-			address += venue['location']['crossStreet']
-
-		# address2
-		address2 = ""
-		if 'postalCode' in venue['location']:
-			address2 = venue['location']['postalCode']
-
-		if 'city' in venue['location']:
-			if address2 != "":
-				address2 += ", "
-			address2 += venue['location']['city']
-
-		# times
-		if 'beenHere' in venue:
-			if isinstance(venue['beenHere'], int):
-				count = venue['beenHere']
-			else:
-				count = venue['beenHere']['count']
-			times = "<b>You've been here "
-			if count == 1:
-				times += "once"
-			else:
-				times += str(count) + " times"
-			times += "</b>"
-		else:
-			times = "<b>You've never been here</b>"
-
 		checkin_button = QPushButton("Check-in")
 		self.connect(checkin_button, SIGNAL("clicked()"), self.checkin)
 
 		self.checkinDone = Signal()
 		self.connect(self, SIGNAL("checkinDone(str)"), self.__checkinDone)
 
-		i = 0
-		gridLayout.addWidget(checkin_button, i, 1)
 		self.shoutText = QLineEdit(self)
 		self.shoutText.setPlaceholderText("Shout something")
-		gridLayout.addWidget(self.shoutText, i, 0)
-		i += 1
-		gridLayout.addWidget(Title(name, self), i, 0, 1, 2)
-		i += 1
-		gridLayout.addWidget(QLabel(address, self), i, 0, 1, 2)
-		i += 1
-		gridLayout.addWidget(QLabel(address2, self), i, 0, 1, 2)
-		for item in venue['categories']:
-			if 'primary' in item and item['primary'] == "true":
-				i += 1
-				gridLayout.addWidget(QLabel(item['name'], self), i, 0, 1, 2)
-		i += 1
-		gridLayout.addWidget(Ruler(), i, 0, 1, 2)
 
-		if 'description' in venue:
+		self.nameTitle = Title("", self)
+		self.addressLabel = QLabel(self)
+		self.address2Label = QLabel(self)
+		self.categoryLabel = QLabel(self)
+		self.descriptionLabel = QLabel(self)
+		self.descriptionLabel.setWordWrap(True)
+		self.descriptionRuler = Ruler()
+		self.timesLabel = QLabel(self)
+		self.checkinsLabel = QLabel(self)
+		self.visitorsLabel = QLabel(self)
+		self.hereNowLabel = QLabel(self)
+
+		self.phoneCallButton = QPushButton()
+		self.phoneCallButton.setIcon(QIcon.fromTheme("general_call"))
+		self.connect(self.phoneCallButton, SIGNAL("clicked()"), self.startPhoneCall)
+
+		self.websiteButton = QPushButton("Visit Website")
+		self.websiteButton.setIcon(QIcon.fromTheme("general_web"))
+		self.connect(self.websiteButton, SIGNAL("clicked()"), self.openUrl)
+
+		self.mayorButton = QPushButton()
+		self.noMayorLabel = QLabel("This venue has no mayor", self)
+
+		# TODO: menu
+		# TODO: specials
+
+		self.tipsLabel = QLabel(self)
+		self.tips = TipList([], self)
+		self.newTip = NewTipWidget(venue['id'], self)
+
+		self.more_info_button = QPushButton()
+		self.more_info_button.setIcon(QIcon.fromTheme("general_refresh"))
+		self.connect(self.more_info_button, SIGNAL("clicked()"), self.more_info)
+
+		i = 0
+		gridLayout.addWidget(checkin_button, i, 1)
+		gridLayout.addWidget(self.shoutText, i, 0)
+		for widget in (self.nameTitle, self.addressLabel, self.address2Label, self.categoryLabel,
+				Ruler(), self.descriptionLabel, self.descriptionRuler):
 			i += 1
-			description_label = QLabel(venue['description'])
-			description_label.setWordWrap(True)
-			gridLayout.addWidget(description_label, i, 0, 1, 2)
+			gridLayout.addWidget(widget, i, 0, 1, 2)
+		for widget in (self.timesLabel, self.checkinsLabel, self.visitorsLabel, self.hereNowLabel):
 			i += 1
-			gridLayout.addWidget(Ruler(), i, 0, 1, 2)
-
-		i += 1
-		gridLayout.addWidget(QLabel(times, self), i, 0)
-		i += 1
-		gridLayout.addWidget(QLabel("Total Checkins: " + str(venue['stats']['checkinsCount']), self), i, 0)
+			gridLayout.addWidget(widget, i, 0)
+		for widget in (self.phoneCallButton, self.websiteButton, self.mayorButton, self.noMayorLabel):
+			i += 1
+			gridLayout.addWidget(widget, i, 0, 1, 2)
 		i += 1
-		gridLayout.addWidget(QLabel("Total Visitors: " + str(venue['stats']['usersCount']), self), i, 0)
+		gridLayout.addWidget(self.tipsLabel, i, 0)
+		for widget in (self.tips, self.newTip, self.more_info_button):
+			i += 1
+			gridLayout.addWidget(widget, i, 0, 1, 2)
+
+		showMoreInfo = Signal()
+		self.connect(self, SIGNAL("showMoreInfo()"), self.more_info)
+
+		detailsFetched = Signal()
+		self.connect(self, SIGNAL("detailsFetched()"), self.__detailsFetched)
+
+		cacheUpdated = Signal()
+		self.connect(self, SIGNAL("cacheUpdated()"), self.__cacheUpdated)
+
+		self.showVenue(venue, fullDetails)
+		if not fullDetails:
+			self.fetchDetails()
+
+	def showVenue(self, venue, fullDetails):
+		"""
+		Updates every section with venue.  Sections for which there's no data
+		are hidden.
+		"""
+		self.venue = venue
+		self.fullDetails = fullDetails
+		details = objects.Venue.get(venue)
+
+		self.setWindowTitle(details.name)
+
+		# name
+		name = details.name
+		if details.categories:
+			name += " (" + details.categories[0] + ")"
+		self.nameTitle.setText(name)
+
+		self.addressLabel.setText(details.streetLine())
+		self.address2Label.setText(details.cityLine())
+		self.categoryLabel.setText(details.primaryCategory or "")
+		self.categoryLabel.setVisible(details.primaryCategory is not None)
+
+		self.descriptionLabel.setText(venue.get('description', ""))
+		self.descriptionLabel.setVisible('description' in venue)
+		self.descriptionRuler.setVisible('description' in venue)
+
+		# times
+		if details.beenHere is not None:
+			count = details.beenHere
+			times = "<b>You've been here "
+			if count == 1:
+				times += "once"
+			else:
+				times += str(count) + " times"
+			times += "</b>"
+		else:
+			times = "<b>You've never been here</b>"
+		self.timesLabel.setText(times)
+
+		self.checkinsLabel.setText("Total Checkins: " + str(details.checkinsCount))
+		self.checkinsLabel.setVisible(details.checkinsCount is not None)
+		self.visitorsLabel.setText("Total Visitors: " + str(details.usersCount))
+		self.visitorsLabel.setVisible(details.usersCount is not None)
 
 		if 'hereNow' in venue:
 			hereNow = venue['hereNow']['count']
@@ -330,74 +696,40 @@ class VenueDetailsWindow(UberSquareWindow):
 				hereNow = "There's just one person here now."
 			else:
 				hereNow = "There are " + repr(hereNow) + " people here now."
-			i += 1
-			gridLayout.addWidget(QLabel(hereNow, self), i, 0)
-
-		if 'phone' in venue['contact']:
-			i += 1
-			phoneCallButton = QPushButton("Call (" + venue['contact']['formattedPhone'] + ")")
-			phoneCallButton.setIcon(QIcon.fromTheme("general_call"))
-			self.connect(phoneCallButton, SIGNAL("clicked()"), self.startPhoneCall)
-			gridLayout.addWidget(phoneCallButton, i, 0, 1, 2)
-
-		if 'url' in venue:
-			i += 1
-			websiteButton = QPushButton("Visit Website")
-			websiteButton.setIcon(QIcon.fromTheme("general_web"))
-			self.connect(websiteButton, SIGNAL("clicked()"), self.openUrl)
-			gridLayout.addWidget(websiteButton, i, 0, 1, 2)
-
-		if 'mayor' in venue:
-			if 'user' in venue['mayor']:
-				mayorName = venue['mayor']['user']['firstName']
-				mayorCount = venue['mayor']['count']
-				mayorText = mayorName + " is the mayor with " + str(mayorCount) + " checkins!"
-				mayorButton = QPushButton()
-				mayorButton.setText(mayorText)
-				mayorButton.setIcon(QIcon(foursquare.image(venue['mayor']['user']['photo'])))
-			else:
-				mayorButton = QLabel("This venue has no mayor")
-			i += 1
-			gridLayout.addWidget(mayorButton, i, 0, 1, 2)
-
-		# TODO: menu
-		# TODO: specials
+			self.hereNowLabel.setText(hereNow)
+		self.hereNowLabel.setVisible('hereNow' in venue)
+
+		contact = venue.get('contact', {})
+		if 'phone' in contact:
+			self.phoneCallButton.setText("Call (" + contact.get('formattedPhone', contact['phone']) + ")")
+		self.phoneCallButton.setVisible('phone' in contact)
+		self.websiteButton.setVisible('url' in venue)
+
+		mayor = venue.get('mayor')
+		if mayor and 'user' in mayor:
+			mayorText = mayor['user']['firstName'] + " is the mayor with " + str(mayor['count']) + " checkins!"
+			self.mayorButton.setText(mayorText)
+			self.mayorButton.setIcon(icon(mayor['user']['photo']))
+		self.mayorButton.setVisible(mayor is not None and 'user' in mayor)
+		self.noMayorLabel.setVisible(mayor is not None and 'user' not in mayor)
 
 		if 'tips' in venue:
-			i += 1
-			if venue['tips']['count'] == 0:
-				gridLayout.addWidget(QLabel("<b>There isn't a single tip!</b>", self), i, 0)
+			count = venue['tips']['count']
+			if count == 0:
+				self.tipsLabel.setText("<b>There isn't a single tip!</b>")
+			elif count == 1:
+				self.tipsLabel.setText("<b>Just one tip</b>")
 			else:
-				if venue['tips']['count'] == 1:
-					gridLayout.addWidget(QLabel("<b>Just one tip</b>", self), i, 0)
-				else:
-					gridLayout.addWidget(QLabel("<b>" + str(venue['tips']['count']) + " tips</b>", self), i, 0)
-				for group in venue['tips']['groups']:
-					for tip in group['items']:
-						i += 1
-						gridLayout.addWidget(Tip(tip), i, 0, 1, 2)
-						i += 1
-						line = QFrame()
-						line.setFrameShape(QFrame.HLine)
-						line.setMaximumWidth(QApplication.desktop().screenGeometry().width() * 0.5)
-						gridLayout.addWidget(line, i, 0, 1, 2)
-
-			i += 1
-			gridLayout.addWidget(NewTipWidget(venue['id'], self), i, 0, 1, 2)
+				self.tipsLabel.setText("<b>" + str(count) + " tips</b>")
+			self.tips.setRows(tip_rows(venue['tips'].get('groups', [])))
+		self.tipsLabel.setVisible('tips' in venue)
+		self.tips.setVisible('tips' in venue and venue['tips']['count'] > 0)
+		self.newTip.setVisible('tips' in venue)
 
 		if not fullDetails:
-			info_button_label = "Fetch full details"
+			self.more_info_button.setText("Fetch full details")
 		else:
-			info_button_label = "Refresh venue details"
-		more_info_button = QPushButton(info_button_label)
-		more_info_button.setIcon(QIcon.fromTheme("general_refresh"))
-		self.connect(more_info_button, SIGNAL("clicked()"), self.more_info)
-
-		i += 1
-		gridLayout.addWidget(more_info_button, i, 0, 1, 2)
-
-		showMoreInfo = Signal()
-		self.connect(self, SIGNAL("showMoreInfo()"), self.more_info)
+			self.more_info_button.setText("Refresh venue details")
 
 	def startPhoneCall(self):
 		QDesktopServices.openUrl("tel:" + self.venue['contact']['phone'])
@@ -405,43 +737,46 @@ class VenueDetailsWindow(UberSquareWindow):
 	def openUrl(self):
 		QDesktopServices.openUrl(self.venue['url'])
 
-	def __showWaitingDialog(self):
-		self.waitDialog.exec_()
-
-	def __hideWaitingDialog(self):
-		self.waitDialog.hide()
-
 	def more_info(self):
 		if not self.fullDetails:
 			venue = foursquare.venues_venue(self.venue['id'], Cache.CacheOrNull)
 			if venue:
-				self.close()
-				VenueDetailsWindow(self.parent(), venue, True).show()
+				self.showVenue(venue, True)
 				return
-		# FIXME!
-		self.fullDetails = False
+		self.fetchDetails()
+
+	def fetchDetails(self):
+		if self.fetching:
+			return
+		self.fetching = True
+		self.setAttribute(Qt.WA_Maemo5ShowProgressIndicator, True)
 		VenueDetailsThread(self.venue['id'], self).start()
-		self.__showWaitingDialog()
+
+	def __detailsFetched(self):
+		self.fetching = False
+		self.setAttribute(Qt.WA_Maemo5ShowProgressIndicator, False)
+		self.__cacheUpdated()
+
+	def __cacheUpdated(self):
+		venue = foursquare.venues_venue(self.venue['id'], Cache.CacheOrNull)
+		if venue:
+			self.showVenue(venue, True)
 
 	def checkin(self):
 		c = CheckinConfirmation(self, self.venue)
 		c.exec_()
 		if c.result() == QDialog.Accepted:
 			QMaemo5InformationBox.information(self, "Checking in...")
-			try:
-				ll = LocationProvider().get_ll(self.venue)
-				checkin = Checkin(self.venue, ll, self.shoutText.text(), c.broadcast())
-
-				CheckinThread(checkin, self).start()
-			except IOError:
-				self.networkError.emit()
+			# The location is looked up by the thread
+			checkin = Checkin(self.venue, None, self.shoutText.text(), c.broadcast())
+			CheckinThread(checkin, self).start()
 
 	def __checkinDone(self, response):
 		CheckinDetails(self, response).show()
 
 
 class NewVenueWindow(QMainWindow):
-	def __init__(self, parent, categories, ll):
+	def __init__(self, parent, ll):
 		super(NewVenueWindow, self).__init__(parent)
 		self.setAttribute(Qt.WA_Maemo5StackedWindow)
 		self.venue = dict()
@@ -529,11 +864,6 @@ class NewVenueWindow(QMainWindow):
 		self.connect(self.add_venue_button, SIGNAL("clicked()"), self.add_venue)
 		gridLayout.addWidget(self.add_venue_button, i, 0, 1, 2)
 
-	def category_selected(self, index):
-		if index != -1:
-			subcategories = self.category.pickSelector().model().get_data(index)['categories']
-			self.subcategory.setPickSelector(CategorySelector(subcategories))
-
 	def add_venue(self):
 		if self.name.text() == "":
 			self.ibox = QMaemo5InformationBox()
@@ -565,12 +895,7 @@ class NewVenueWindow(QMainWindow):
 		if response['meta']['code'] == 409:
 			title = "Duplicate detected"
 
-			venues = dict()
-			i = 0
-			for venue in response['response']['candidateDuplicateVenues']:
-				venues[i] = dict()
-				venues[i]['venue'] = venue
-				i += 1
+			venues = foursquare.wrap_venues(response['response']['candidateDuplicateVenues'])
 
 			msgBox = QMessageBox(self)
 			msgBox.setText("Foursquare says this venue looks like a duplicate.<br> Make sure it isn't; if it is, then click \"Add Venue\" again.")